@@ -0,0 +1,150 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Admission control for transcodes based on the available disk space.
+
+A job reserves the estimated size of its output before it starts and only
+starts if the reservation fits. Reservations are released when the job is
+done, its files are then accounted for by the file system itself.
+"""
+
+import transcode
+
+import os
+import threading
+
+# Added to the size of every file of a transcode to account for metadata
+# and partially used blocks.
+FILE_OVERHEAD = 4096
+
+# The estimated size of a transcode is multiplied with this factor.
+SAFETY_FACTOR = 1.1
+
+# Size in bytes of a SHA-1 hash of a torrent piece.
+PIECE_HASH_SIZE = 20
+
+class Reservation:
+    """
+    Disk space reserved with `SpaceReserver.reserve`.
+
+    Can be used as a context manager which releases it on exit.
+    """
+    def __init__(self, reserver, nbytes):
+        self.reserver = reserver
+        self.nbytes = nbytes
+
+    def release(self):
+        if self.reserver is not None:
+            self.reserver._release(self.nbytes)
+            self.reserver = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+        return False
+
+class SpaceReserver:
+    """
+    Keeps track of the disk space reserved by running jobs on a file system.
+
+    A reservation only succeeds if the free space reported by `statvfs`
+    minus all outstanding reservations minus `keep_free` is large enough
+    and, if `budget` is given, all outstanding reservations together don't
+    exceed it. Space which is already written by a running job is counted
+    twice, so the check errs on the safe side.
+
+    :param path: A path on the file system.
+    :param keep_free: Number of bytes that must stay free.
+    :param budget: Maximum number of bytes reserved at the same time or
+                   `None` for no limit.
+    """
+    def __init__(self, path, keep_free=0, budget=None):
+        self.path = path
+        self.keep_free = keep_free
+        self.budget = budget
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def free(self):
+        """Bytes available to unprivileged users on the file system."""
+        st = os.statvfs(str(self.path))
+        return st.f_bavail * st.f_frsize
+
+    def available(self):
+        """Bytes which can still be reserved."""
+        with self.lock:
+            return self._available()
+
+    def _available(self):
+        available = self.free() - self.reserved - self.keep_free
+        if self.budget is not None:
+            available = min(available, self.budget - self.reserved)
+        return max(0, available)
+
+    def reserve(self, nbytes):
+        """
+        Reserve `nbytes` bytes.
+
+        :returns: A `Reservation` or `None` if there isn't enough space.
+        """
+        with self.lock:
+            if nbytes > self._available():
+                return None
+            self.reserved += nbytes
+            return Reservation(self, nbytes)
+
+    def _release(self, nbytes):
+        with self.lock:
+            self.reserved -= nbytes
+
+def estimate_transcode_size(path, info, oformat, model):
+    """
+    Estimate the size of a transcode including the copied extra files.
+
+    :param path: `Path` to the source directory.
+    :param info: The `planner.ReleaseInfo` of the source.
+    :param oformat: The output format.
+    :param model: The `planner.CostModel` used to estimate the bitrate.
+
+    :returns: The estimated size in bytes.
+    """
+    size = model.output_bytes(info, oformat) + info.tracks * FILE_OVERHEAD
+    for f in path.glob("**/*"):
+        if f.suffix in transcode.ALLOWED_EXTENSIONS and f.is_file():
+            size += f.stat().st_size + FILE_OVERHEAD
+    return int(size * SAFETY_FACTOR)
+
+def estimate_torrent_size(data_size, nfiles, piece_length=18):
+    """
+    Estimate the size of a .torrent file.
+
+    :param data_size: Size of all files of the torrent in bytes.
+    :param nfiles: Number of files in the torrent.
+    :param piece_length: The piece length in 2^n bytes.
+                         (see `util.create_torrent_file`)
+    """
+    pieces = data_size // 2**piece_length + 1
+    # piece hashes plus a generous guess for the bencoded file list
+    return pieces * PIECE_HASH_SIZE + nfiles * 512 + FILE_OVERHEAD
@@ -21,9 +21,13 @@ SOFTWARE.
 """
 
 import formats
+from metrics import NullMetrics
 
-import requests
-from bs4 import BeautifulSoup
+# aiohttp and lxml are imported where they are used to keep the startup
+# of the command line interface fast.
+import asyncio
+import threading
+import random
 import re
 import time
 import json
@@ -37,176 +41,447 @@ USER_AGENT = ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_3)"
               "AppleWebKit/535.11 (KHTML, like Gecko) Chrome/17.0.963.79"
               "Safari/535.11")
 
+# Timeouts for connecting to the site and for every read in seconds.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# Number of times a failed idempotent request is repeated.
+MAX_RETRIES = 4
+
+# The n-th retry waits a random time between 0 and
+# min(BACKOFF_MAX, BACKOFF_BASE * 2^n) seconds.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# The circuit breaker opens after this many failed requests in a row and
+# stays open for BREAKER_COOLDOWN seconds.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 300
+
+# Size of the chunks in which better.php pages are read and parsed.
+PAGE_CHUNK_SIZE = 64 * 1024
+
 class ApiError(Exception):
     pass
 
+class ApiUnavailableError(ApiError):
+    """
+    The site couldn't be reached, timed out or answered with a server error.
+
+    In contrast to other `ApiError`s the request may succeed later.
+    """
+    pass
+
+class CircuitBreaker:
+    """
+    Stops all requests to the site during an outage.
+
+    After `threshold` failed requests in a row the breaker opens and no
+    requests are allowed for `cooldown` seconds. A request counts as failed
+    once it gave up, not for every retry. After that a single request
+    is allowed, if it succeeds the breaker closes again, if it fails it
+    stays open for another `cooldown` seconds.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+
+    def remaining(self):
+        """Seconds till the next request is allowed."""
+        if self.opened is None:
+            return 0
+        return max(0, self.opened + self.cooldown - time.monotonic())
+
+    def allow(self):
+        return self.remaining() == 0
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+def backoff_delay(attempt):
+    """Jittered exponential backoff before retry number `attempt`."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
 class ApolloApi:
-    def __init__(self, cache_path=None):
-        self.session = requests.Session()
-        self.session.headers.update({"User-Agent": USER_AGENT})
-        self.authenticated = False
-        self.rate_limit = 2 # minimum time between two requests in seconds
-        self.last_request = time.time()
-        self.cache = TorrentCache(self, cache_path)
+    """
+    Client for the apollo.rip API.
+
+    A synchronous wrapper around `asyncapi.AsyncApolloApi` which runs it on
+    an event loop in a background thread. Requests started with `prefetch`
+    keep running there while the caller works, they share the rate limit,
+    the circuit breaker and the `TorrentCache` with all other requests.
+
+    Use it as a context manager or call `close` when done.
+    """
+    def __init__(self, cache_path=None, site_url=SITE_URL, rate_limit=2,
+                 session_path=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 retries=MAX_RETRIES, breaker=None):
+        """
+        Constructor
+
+        :param cache_path: Path of the json file used by the `TorrentCache`.
+        :param site_url: Base URL of the site. Only useful for testing.
+        :param rate_limit: Minimum time between two requests in seconds.
+        :param session_path: Path of a json file in which the session
+                             cookies and account data are kept between runs.
+        :param timeout: Tuple of the connect and read timeout in seconds.
+        :param retries: Number of retries of failed idempotent requests.
+        :param breaker: A `CircuitBreaker` or `None` for the default one.
+        """
+        import asyncapi
+
+        self.async_api = asyncapi.AsyncApolloApi(
+                cache_path, site_url, rate_limit, session_path, timeout,
+                retries, breaker)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name="apolloapi", daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        # cache, breaker, username, passkey, ... of the async client
+        if name == "async_api":
+            raise AttributeError(name)
+        return getattr(self.async_api, name)
+
+    @property
+    def metrics(self):
+        return self.async_api.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self.async_api.metrics = metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def close(self):
+        """Close all connections and stop the background thread."""
+        if self.loop.is_closed():
+            return
+        self._run(self.async_api.close())
+        self._run(self.loop.shutdown_asyncgens())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _run(self, coro):
+        """Run `coro` on the event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
 
     def login(self, username, password):
         """
         Authenticate with the apollo server.
 
+        If `session_path` contains a session of `username` it is used without
+        sending any request. It is verified by the first request and a full
+        login is done if the server rejects it.
+
         :raises ApiError: If the login failed.
         """
-        r = self.session.post(SITE_URL + "/login.php",
-                              data={"username": username,
-                                    "password": password,
-                                    "login": "Log in"},
-                              allow_redirects=False)
-        if r.status_code == 302 and r.headers["location"] != "login.php":
-            r = self.get_index()
-            if r is not None:
-                self.username = r["username"]
-                self.uid = r["id"]
-                self.authkey = r["authkey"]
-                self.passkey = r["passkey"]
-                self.authenticated = True
-                return
-
-        raise ApiError("Login failed.")
-
-    def _api_request(self, action, **kwargs):
-        while time.time() - self.last_request < self.rate_limit:
-            time.sleep(0.1)
-        self.last_request = time.time()
-
-        params = {"action": action}
-        params.update(kwargs)
-        r = self.session.get(SITE_URL + "/ajax.php", params=params)
-        if r.status_code == 200:
-            r = r.json()
-            if r.get("status", "") == "success":
-                return unescape(r["response"])
-            elif r.get("status", "") == "failure" and "error" in r:
-                raise ApiError("API request failed. Error: '{}'".format(r["error"]))
-            else:
-                raise ApiError("API request failed. ({})".format(str(r)))
-        else:
-            raise ApiError("API request failed with status code {}".format(r.status_code))
-            
+        self._run(self.async_api.login(username, password))
 
     def get_better_snatched(self):
-        if not self.authenticated:
-            return
+        """
+        Get the transcode candidates from better.php.
 
-        re_artist = re.compile(r"artist\.php\?id=(?P<artistid>[0-9]+)")
-        re_torrent = re.compile(r"torrents\.php\?id=(?P<groupid>[0-9]+)&torrentid=(?P<torrentid>[0-9]+)")
+        All pages are fetched if the list is split into multiple pages.
+        Every page is read completely before its candidates are yielded,
+        so no connection is kept open while the caller works on them. The
+        next page is only fetched when the candidates of the previous one
+        are used up.
 
-        r = self.session.get(SITE_URL + "/better.php?method=snatch")
+        :returns: A generator yielding a `dict` for every candidate.
+        :raises ApiError: If a page couldn't be fetched. The candidates of
+                          the pages before were yielded already.
+        """
+        pages = self.async_api.better_pages()
+        try:
+            while True:
+                with self.metrics.stage("fetch_candidates"):
+                    try:
+                        candidates = self._run(pages.__anext__())
+                    except StopAsyncIteration:
+                        return
+                yield from candidates
+        finally:
+            if not self.loop.is_closed():
+                self._run(pages.aclose())
+
+    def get_torrent(self, tid, caching=True, gid=None):
+        """
+        Get information about a torrent.
 
-        if r.status_code != 200:
-            raise ApiError("Couldn't fetch better snatched. (Statuscode: {})".format(r.status_code))
+        :param tid: ID of the torrent.
+        :param caching: Use the `TorrentCache`.
+        :param gid: ID of the group of the torrent if known. If the torrent
+                    is not cached the whole group is fetched which also
+                    caches all other torrents of the group.
+        """
+        return self._run(self.async_api.get_torrent(tid, caching, gid))
 
-        soup = BeautifulSoup(r.content, "lxml")
+    def get_group(self, gid, max_age=None):
+        """
+        Get information about a torrent group and all its torrents.
 
-        torrents = []
-        for entry in soup.find_all("tr", class_="torrent_row"):
-            t = {}
+        All torrents of the group are added to the `TorrentCache`.
 
-            artist = entry.find("a", href=re_artist)
-            if artist:
-                t["artist"] = artist.string
-                t["artistid"] = re_artist.search(artist.get("href"))["artistid"]
-            else:
-                t["artist"] = "Various Artists"
+        :param gid: ID of the group.
+        :param max_age: If not `None` a group fetched during the last
+                        `max_age` seconds is returned without a new request.
+        """
+        return self._run(self.async_api.get_group(gid, max_age))
 
-            torrent = entry.find("a", href=re_torrent)
-            t["name"] = torrent.string
-            r = re_torrent.search(torrent.get("href"))
-            t["groupid"] = r["groupid"]
-            t["torrentid"] = r["torrentid"]
+    def get_index(self):
+        return self._run(self.async_api.get_index())
 
-            needed = []
-            v2 = entry.td.find_next_sibling("td")
-            if v2.string == "NO":
-                needed.append(formats.FormatV2)
-            v0 = v2.find_next_sibling("td")
-            if v0.string == "NO":
-                needed.append(formats.FormatV0)
-            f320 = v0.find_next_sibling("td")
-            if f320.string == "NO":
-                needed.append(formats.Format320)
-            t["formats_needed"] = needed
+    def prefetch(self, tid, gid):
+        """
+        Fetch the group `gid` of the torrent `tid` into the cache in the
+        background and return immediately.
 
-            torrents.append(t)
+        See `asyncapi.AsyncApolloApi.prefetch`.
+        """
+        self.loop.call_soon_threadsafe(self.async_api.prefetch, tid, gid)
 
-        return torrents
+    def add_format(self, torrent, format, tfile, description=""):
+        """
+        Upload a transcode.
 
-    def get_torrent(self, tid, caching=True):
-        if caching:
-            return self.cache.get(tid)
-        else:
-            return self._api_request("torrent", id=tid)
+        The upload is never repeated automatically. If it raises an
+        `ApiUnavailableError` it may still have reached the site, check
+        the group before trying again.
+        """
+        return self._run(self.async_api.add_format(torrent, format, tfile, description))
 
-    def get_group(self, gid):
-        return self._api_request("torrentgroup", id=gid)
+def parse_response(r):
+    """
+    Extract the response of a decoded ajax.php json object.
 
-    def get_index(self):
-        return self._api_request("index")
-    
-    def add_format(self, torrent, format, tfile, description=""):
-        if format not in formats.FORMATS:
-            return False # TODO indicate "not a valid format" error
-
-        gid = torrent["group"]["id"]
-        torrent = torrent["torrent"]
-
-        data = {
-            "submit": "true",
-            "auth": self.authkey,
-            "groupid": str(gid),
-            "type": 0,
-            "format": format.FORMAT,
-            "bitrate": format.BITRATE,
-            "media": torrent["media"],
-            "release_desc": description
-        }
-
-        if torrent["remastered"]:
-            data["remaster"] = "on"
-            data["remaster_year"] = str(torrent["remasterYear"])
-            data["remaster_title"] = torrent["remasterTitle"]
-            data["remaster_record_label"] = torrent["remasterRecordLabel"]
-            data["remaster_catalogue_number"] = torrent["remasterCatalogueNumber"]
-            
-
-        files = {"file_input": (tfile.name, tfile.open("rb"), "application/x-bittorrent")}
-
-        # urllib3 (and therefore requests) incorrectly encodes utf-8 file names
-        # The commented-out code is the normal code that we can use once
-        # urllib3 fixes this bug.
+    :param r: The json object as returned by `decode_json`.
+
+    :raises ApiError: If the request failed.
+    """
+    if r.get("status", "") == "success":
+        return r["response"]
+    elif r.get("status", "") == "failure" and "error" in r:
+        raise ApiError("API request failed. Error: '{}'".format(r["error"]))
+    else:
+        raise ApiError("API request failed. ({})".format(str(r)))
+
+RE_ARTIST = re.compile(r"artist\.php\?id=(?P<artistid>[0-9]+)")
+RE_TORRENT = re.compile(r"torrents\.php\?id=(?P<groupid>[0-9]+)&torrentid=(?P<torrentid>[0-9]+)")
+
+def parse_better_row(row):
+    """
+    Parse a single torrent_row `tr` element of better.php.
+
+    :returns: A `dict` describing the candidate.
+    """
+    t = {}
+    artist = None
+    torrent = None
+    for a in row.iter("a"):
+        href = a.get("href", "")
+        if artist is None and RE_ARTIST.search(href):
+            artist = a
+        elif torrent is None and RE_TORRENT.search(href):
+            torrent = a
+
+    if artist is not None:
+        t["artist"] = "".join(artist.itertext())
+        t["artistid"] = RE_ARTIST.search(artist.get("href"))["artistid"]
+    else:
+        t["artist"] = "Various Artists"
+
+    t["name"] = "".join(torrent.itertext())
+    r = RE_TORRENT.search(torrent.get("href"))
+    t["groupid"] = r["groupid"]
+    t["torrentid"] = r["torrentid"]
+
+    needed = []
+    tds = row.findall("td")
+    for td, f in zip(tds[1:4], (formats.FormatV2, formats.FormatV0, formats.Format320)):
+        if "".join(td.itertext()).strip() == "NO":
+            needed.append(f)
+    t["formats_needed"] = needed
+
+    return t
+
+class BetterParser:
+    """
+    Incremental parser for better.php pages.
+
+    Rows are discarded as soon as they are parsed so memory usage doesn't
+    depend on the size of the page.
+    """
+    def __init__(self):
+        from lxml import etree
+
+        self.parser = etree.HTMLPullParser(events=("end",))
+        # the link to the next page, known after `close`
+        self.next_page = None
+
+    def feed(self, chunk):
+        """
+        Parse the next chunk of the page.
+
+        :param chunk: `bytes` containing the next part of the html.
+
+        :returns: A `list` with a `dict` for every candidate completed by
+                  this chunk.
         """
-        r = self.session.post(SITE_URL + "/upload.php",
-                              params={"groupid": gid},
-                              data=data,
-                              files=files,
-                              allow_redirects=False)
+        self.parser.feed(chunk)
+        return self._read()
+
+    def close(self):
         """
-        # workaround from
-        # http://linuxonly.nl/docs/68/167_Uploading_files_with_non_ASCII_filenames_using_Python_requests.html
-        def rewrite_request(prepped):
-            filename = tfile.name.encode("utf-8")
-            prepped.body = re.sub(b"filename\*=.*",
-                                  b'filename="' + filename + b'"',
-                                  prepped.body)
-            return prepped
-
-        r = self.session.post(SITE_URL + "/upload.php",
-                              params={"groupid": gid},
-                              data=data,
-                              files=files,
-                              allow_redirects=False,
-                              auth=rewrite_request)
-
-        if r.status_code != 302:
-            raise ApiError("Couldn't add format. (Status code: {})".format(r.status_code))
+        Finish parsing the page.
+
+        :returns: A `list` with the remaining candidates.
+        """
+        self.parser.close()
+        return self._read()
+
+    def _read(self):
+        candidates = []
+        for _, elem in self.parser.read_events():
+            if elem.tag == "tr":
+                if "torrent_row" in elem.get("class", "").split():
+                    candidates.append(parse_better_row(elem))
+                elem.clear()
+                # also drop the references of the parent to the finished rows
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif elem.tag == "a" and "pager_next" in elem.get("class", "").split():
+                self.next_page = elem.get("href")
+        return candidates
+
+def iter_better(chunks):
+    """
+    Incrementally parse a better.php page.
+
+    :param chunks: An iterable of `bytes` containing the html of the page.
+
+    :returns: A generator yielding a `dict` for every candidate. Its return
+              value is the link to the next page or `None` if this is the
+              last page.
+    """
+    parser = BetterParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+    return parser.next_page
+
+def parse_better(content):
+    """
+    Parse the transcode candidates of a better.php page.
+
+    :param content: The html of the page.
+
+    :returns: A tuple of a `list` with a `dict` for each candidate and the
+              link to the next page or `None`.
+    """
+    return parse_better_chunks((content,))
+
+def parse_better_chunks(chunks):
+    """
+    Like `parse_better` but for a page split into an iterable of `bytes`.
+    """
+    it = iter_better(chunks)
+    torrents = []
+    while True:
+        try:
+            torrents.append(next(it))
+        except StopIteration as e:
+            return torrents, e.value
+
+def upload_data(torrent, format, authkey, description=""):
+    """
+    Generate the form fields for uploading a new format of a torrent.
+
+    :param torrent: A `dict` as returned by `get_torrent`.
+    :param format: The format of the upload. (see `formats`)
+    :param authkey: The authkey of the user.
+    :param description: The release description.
+    """
+    gid = torrent["group"]["id"]
+    torrent = torrent["torrent"]
+
+    data = {
+        "submit": "true",
+        "auth": authkey,
+        "groupid": str(gid),
+        "type": 0,
+        "format": format.FORMAT,
+        "bitrate": format.BITRATE,
+        "media": torrent["media"],
+        "release_desc": description
+    }
+
+    if torrent["remastered"]:
+        data["remaster"] = "on"
+        data["remaster_year"] = str(torrent["remasterYear"])
+        data["remaster_title"] = torrent["remasterTitle"]
+        data["remaster_record_label"] = torrent["remasterRecordLabel"]
+        data["remaster_catalogue_number"] = torrent["remasterCatalogueNumber"]
+
+    return data
+
+def _unescape_list(l):
+    """Unescape all strings in a list and its nested lists in place."""
+    for i, x in enumerate(l):
+        if isinstance(x, str):
+            if "&" in x:
+                l[i] = html.unescape(x)
+        elif isinstance(x, list):
+            _unescape_list(x)
+    return l
+
+def _unescape_pairs(pairs):
+    """
+    `object_pairs_hook` for `json.loads` which unescapes all strings.
+
+    Nested objects have allready been unescaped by their own call, so only
+    the keys, strings and lists of the object itself need to be handled.
+    """
+    obj = {}
+    for k, v in pairs:
+        if "&" in k:
+            k = html.unescape(k)
+        if isinstance(v, str):
+            if "&" in v:
+                v = html.unescape(v)
+        elif isinstance(v, list):
+            _unescape_list(v)
+        obj[k] = v
+    return obj
+
+def decode_json(data):
+    """
+    Decode json and unescape all html entities in all of its strings.
+
+    Same as `unescape(json.loads(data))` but done in a single pass while
+    decoding.
+    """
+    obj = json.loads(data, object_pairs_hook=_unescape_pairs)
+    if isinstance(obj, str):
+        return html.unescape(obj)
+    elif isinstance(obj, list):
+        return _unescape_list(obj)
+    return obj
 
 def unescape(obj):
     """
@@ -224,16 +499,24 @@ def unescape(obj):
 class TorrentCache:
     """
     Caches access to the torrent API endpoint.
+
+    The torrents are stored in the same format as returned by the torrent
+    endpoint, keyed by the torrent ID as string. Responses of the
+    torrentgroup endpoint are split up into entries for all of their
+    torrents.
+
+    Complete groups are additionally kept in memory (not saved) together with
+    the time they were fetched.
     """
-    def __init__(self, api, path=None):
-        self.api = api
+    def __init__(self, path=None):
         self.clear()
+        self.path = path
         if path:
             self.load(path)
-            self.path = path
         
     def clear(self):
         self.torrents = {}
+        self.groups = {}
 
     def load(self, path):
         try:
@@ -243,16 +526,35 @@ class TorrentCache:
             pass
 
     def save(self, path=None):
-        if path is None and self.path is not None:
+        if path is None:
             path = self.path
+        if path is None:
+            return
+        # a copy, the event loop thread of `ApolloApi` may add torrents
+        # while they are written
+        torrents = dict(self.torrents)
         with open(path, "w") as f:
-            json.dump(self.torrents, f)
-
-    def get(self, tid):
-        if tid in self.torrents:
-            return self.torrents[tid]
-        else:
-            t = self.api.get_torrent(tid, caching=False)
-            if t:
-                self.torrents.update({tid: t})
-            return t
+            json.dump(torrents, f)
+
+    def add_group(self, group):
+        """
+        Add all torrents of a torrentgroup response to the cache.
+        """
+        for t in group["torrents"]:
+            self.torrents[str(t["id"])] = {"group": group["group"], "torrent": t}
+        self.groups[str(group["group"]["id"])] = (time.time(), group)
+
+    def get_group(self, gid, max_age):
+        """
+        Get a group fetched during the last `max_age` seconds.
+
+        :returns: The group or `None` if it isn't cached or too old.
+        """
+        fetched, group = self.groups.get(str(gid), (0, None))
+        if time.time() - fetched <= max_age:
+            return group
+        return None
+
+    def cached(self, tid):
+        """Get a torrent if it is cached, otherwise return `None`."""
+        return self.torrents.get(str(tid))
@@ -20,44 +20,102 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from apolloapi import ApolloApi, ApiError
+from apolloapi import ApolloApi, ApiError, ApiUnavailableError
 from transcode import transcode, TranscodeError
 import formats
 import util
+from usage import UsageReport
+from metrics import Metrics, NullMetrics
+import planner
+import admission
+import scheduling
+import backends
+import verify
+import vetting
+import lease
 
 import argparse
 import configparser
+import contextlib
 from pathlib import Path
 import tempfile
+import collections
 import shutil
 import re
 import subprocess
 import errno
 import os
+import time
 
 CONFIG_PATH = "apollobetter.conf"
 ANNOUNCE_URL = "https://mars.apollo.rip/{}/announce"
 
+# Maximum age in seconds of a torrent group fetched earlier in the run
+# that is reused instead of fetching it again.
+GROUP_MAX_AGE = 300
+
+# Maximum age in seconds of the torrent group used to check if a format
+# was uploaded by someone else right before transcoding it.
+DEDUPE_MAX_AGE = 60
+
+# Number of upcoming candidates vetted in the background while the current
+# one is transcoded.
+VET_AHEAD = 64
+
+# Number of candidates after the current one whose FLAC files are tested in
+# the background.
+VERIFY_AHEAD = 2
+
 class ApolloBetterError(Exception):
     pass
 
 class ApolloBetter:
     def __init__(self, username, password, search_dirs, output_dir,
             torrent_dir, unique_groups, cache_path=None,
-            continue_on_error=False):
-        self.tmp = tempfile.TemporaryDirectory()
+            continue_on_error=False, spectral_check=None, usage_path=None,
+            metrics=None, api=None, session_path=None, model=None,
+            scratch_dir=None, scratch_budget=None, min_free=0, stage=False,
+            io_jobs=None, limiter=None, backend=None, verify_cache=None,
+            vet_jobs=None, controller=None, leases=None):
+        self.tmp = tempfile.TemporaryDirectory(dir=scratch_dir)
         self.nuploaded = 0
         self.search_dirs = search_dirs
         self.output_dir = output_dir
         self.torrent_dir = torrent_dir
         self.unique_groups = unique_groups
         self.continue_on_error = continue_on_error
-        self.api = ApolloApi(cache_path)
+        self.spectral_check = spectral_check
+        self.stage = stage
+        self.io_jobs = io_jobs
+        self.limiter = limiter
+        # adjusts the number of parallel transcodes, see
+        # `scheduling.ConcurrencyController`
+        self.controller = controller
+        self.leases = leases if leases is not None else lease.NullLeaseManager()
+        self.backend = backend if backend is not None else backends.CliBackend()
+        self.verify_cache = verify_cache
+        self.vetter = vetting.Vetter(search_dirs, vet_jobs)
+        self.usage = UsageReport()
+        self.usage_path = usage_path
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.model = model if model is not None else planner.CostModel()
+        self.output_space = admission.SpaceReserver(output_dir, keep_free=min_free)
+        self.scratch_space = admission.SpaceReserver(self.tmp.name, budget=scratch_budget)
+        # (tid, gid, format) of formats held back for lack of disk space
+        self.held_back = []
+        # uploads which failed because the site was unavailable, see
+        # `upload`
+        self.pending_uploads = []
+        if api is None:
+            api = ApolloApi(cache_path, session_path=session_path)
+        self.api = api
+        self.api.metrics = self.metrics
 
         print("Logging in...")
         self.api.login(username, password)
 
-    def run(self, tids=None, limit=None, allowed_formats=formats.FORMATS):
+    def run(self, tids=None, limit=None, allowed_formats=formats.FORMATS,
+            order="page", budget_cpu=None, budget_time=None):
         """
         Fetch transcode candidates, transcode and upload them.
 
@@ -67,47 +125,331 @@ class ApolloBetter:
         :param limit: Maximumg number of torrents to upload.
         :param allowed_formats: Transcode only to those formats. Other needed
                                 formats are ignored.
+        :param order: "page" to process the candidates in the order of
+                      better.php or "throughput" to process the candidates
+                      with the most uploads per CPU time first.
+        :param budget_cpu: Stop before the CPU time of all transcodes
+                           exceeds this many seconds.
+        :param budget_time: Stop before the run takes longer than this many
+                            seconds, not counting fetching and planning the
+                            candidates.
 
         :returns: The number of torrents that where actually uploaded.
         """
         print("Fetching potential upload candidates from apollo...")
-        candidates = self.api.get_better_snatched()
-
-        candidates = [c for c in candidates if any(f in c["formats_needed"] for f in allowed_formats)]
-
-        if not candidates:
-            print("Their are no candidates for conversion. Nothing to do, exiting...")
+        candidates = self.candidates(allowed_formats)
+        model = self.model
+        budget = budget_cpu is not None or budget_time is not None
+        if order == "throughput" or budget:
+            # Planning needs all candidates up front. Fetching the torrents
+            # which aren't cached would take `rate_limit` seconds each, so
+            # those candidates follow the planned ones and are estimated
+            # when it is their turn. vet_ahead prefetches their torrents.
+            uncached = []
+            jobs = self.plan(self.cached_candidates(candidates, uncached), model)
+            if order == "throughput":
+                jobs = planner.order_jobs(jobs)
+            jobs, skipped = planner.select_jobs(jobs, model, budget_cpu, budget_time)
+            if skipped:
+                print("Skipping {} candidates which don't fit into the budget.".format(len(skipped)))
+            jobs += [planner.Job(c, oformats, None, None) for c, oformats in uncached]
         else:
-            print("Found {} potential candidates.".format(len(candidates)))
-
+            jobs = (planner.Job(c, oformats, None, None) for c, oformats in candidates)
         print()
+        start = time.monotonic()
 
         try:
             nuploaded = 0
-            for c in candidates:
+            ncandidates = 0
+            for job in self.vet_ahead(jobs):
                 if limit is not None and nuploaded >= limit:
                     break
-                nuploaded += self.process_release(
+                if budget:
+                    if job.cpu is None:
+                        job = self.estimate(job, model)
+                    if self.budget_exhausted(job, model, start, budget_cpu, budget_time):
+                        # a smaller candidate may still fit
+                        continue
+                c = job.candidate
+                oformats = job.formats
+                ncandidates += 1
+
+                # Passing the group id fetches the whole group on a cache
+                # miss which caches all other candidates of the group too.
+                self.metrics.begin_release(c["torrentid"])
+                n = self.process_release(
                         c["torrentid"],
-                        allowed_formats.intersection(c["formats_needed"]),
-                        limit - nuploaded if limit is not None else None)
+                        oformats,
+                        limit - nuploaded if limit is not None else None,
+                        c["groupid"])
+                self.metrics.end_release(uploaded=n)
+                nuploaded += n
+
+            # Space may have been freed in the meantime, try once more.
+            held_back, self.held_back = self.held_back, []
+            if held_back:
+                print("Retrying {} formats held back for lack of disk space...".format(len(held_back)))
+            for tid, gid, oformat in held_back:
+                if limit is not None and nuploaded >= limit:
+                    break
+                self.metrics.begin_release(tid)
+                n = self.process_release(
+                        tid,
+                        {oformat},
+                        limit - nuploaded if limit is not None else None,
+                        gid)
+                self.metrics.end_release(uploaded=n)
+                nuploaded += n
+            if self.held_back:
+                print("{} formats were not transcoded for lack of disk space.".format(len(self.held_back)))
+                self.held_back = []
+
+            nuploaded += self.retry_pending_uploads(
+                    limit - nuploaded if limit is not None else None)
         finally:
+            self.vetter.close()
+            self.leases.close()
             self.api.cache.save()
+            self.metrics.write_prometheus()
+            if self.usage_path is not None:
+                self.usage.save(self.usage_path)
+
+        if ncandidates == 0:
+            print("Their are no candidates for conversion. Nothing to do, exiting...")
+
+        if self.usage.records:
+            print()
+            print(self.usage.summary())
 
         return nuploaded
 
-    def process_release(self, tid, oformats, limit=None):
+    def candidates(self, allowed_formats):
+        """
+        Fetch the candidates from better.php.
+
+        If a page of the list can't be fetched the candidates end there.
+
+        :returns: A generator yielding a `(candidate, oformats)` tuple for
+                  every candidate needing one of `allowed_formats`.
+        """
+        try:
+            for c in self.api.get_better_snatched():
+                oformats = allowed_formats.intersection(c["formats_needed"])
+                if oformats:
+                    yield c, oformats
+        except ApiError as e:
+            print("Couldn't fetch all candidates, continuing with the ones fetched so far. ({})".format(e))
+            self.metrics.inc("candidate_fetch_failures_total")
+
+    def vet_ahead(self, jobs, n=VET_AHEAD):
+        """
+        Yield `jobs` while the next `n` candidates are vetted in the
+        background. The torrents of the candidates which aren't cached yet
+        are prefetched and vetted once they are. The FLAC files of the
+        `VERIFY_AHEAD` candidates after the one being processed are tested
+        once they passed vetting.
+        """
+        window = collections.deque()
+        prefetched = set()
+
+        def submit():
+            # the first job is the one yielded next
+            for i, job in enumerate(window):
+                tid = job.candidate["torrentid"]
+                if not self.vetter.submitted(tid):
+                    torrent = self.api.cache.cached(tid)
+                    if torrent is not None:
+                        self.vetter.submit(tid, torrent)
+                    elif tid not in prefetched:
+                        prefetched.add(tid)
+                        self.api.prefetch(tid, job.candidate["groupid"])
+                elif 0 < i <= VERIFY_AHEAD:
+                    self.verify_ahead(tid)
+
+        for job in jobs:
+            window.append(job)
+            if len(window) > n:
+                submit()
+                yield window.popleft()
+        while window:
+            submit()
+            yield window.popleft()
+
+    def verify_ahead(self, tid):
+        """
+        Start testing the FLAC files of the candidate `tid` which aren't
+        in the verify cache yet, once it has been vetted without problems.
+        """
+        if self.verify_cache is None or self.vetter.verify_submitted(tid):
+            return
+        verdict = self.vetter.done(tid)
+        if verdict is None or verdict.path is None or verdict.msg is not None:
+            return
+        self.vetter.submit_verify(tid, verify.unchecked_files(verdict.path, self.verify_cache))
+
+    def cached_candidates(self, candidates, uncached):
+        """
+        Yield the `(candidate, oformats)` tuples of `candidates` whose
+        torrent is cached and append the others to the `list` `uncached`.
+        """
+        for c, oformats in candidates:
+            if self.api.cache.cached(c["torrentid"]) is None:
+                uncached.append((c, oformats))
+            else:
+                yield c, oformats
+
+    def estimate(self, job, model):
+        """
+        Estimate the cost of a job whose torrent wasn't cached while
+        planning. Its torrent is fetched unless it was prefetched already.
+
+        :returns: A new `planner.Job` or `job` itself if its torrent
+                  couldn't be fetched.
+        """
+        c = job.candidate
+        try:
+            torrent = self.api.get_torrent(c["torrentid"], gid=c["groupid"])
+        except ApiError:
+            return job
+        verdict = self.vetter.result(c["torrentid"], torrent, False)
+        return planner.make_job(c, job.formats, verdict.info, model)
+
+    def plan(self, candidates, model, check=False):
+        """
+        Estimate the cost of all candidates.
+
+        Candidates which aren't available locally are dropped.
+
+        :param candidates: An iterable of `(candidate, oformats)` tuples.
+        :param model: The `planner.CostModel` used for the estimates.
+        :param check: Also drop candidates which fail the checks of the
+                      source done before transcoding.
+
+        :returns: A `list` of `planner.Job`s in the order of `candidates`.
+        """
+        print("Estimating the cost of all candidates...")
+        torrents = []
+        for c, oformats in candidates:
+            try:
+                torrent = self.api.get_torrent(c["torrentid"], gid=c["groupid"])
+            except ApiError:
+                if check:
+                    continue
+                # let process_release deal with the error
+                torrent = None
+            if torrent is not None:
+                self.vetter.submit(c["torrentid"], torrent, check)
+            torrents.append((c, oformats, torrent))
+
+        jobs = []
+        for c, oformats, torrent in torrents:
+            info = None
+            if torrent is not None:
+                verdict = self.vetter.result(c["torrentid"], torrent, check)
+                if verdict.path is None:
+                    continue
+                if check and (not self.check_log(torrent) or verdict.msg is not None):
+                    continue
+                info = verdict.info
+            jobs.append(planner.make_job(c, oformats, info, model))
+        return jobs
+
+    def show_plan(self, allowed_formats=formats.FORMATS):
+        """
+        Print the estimated cost of transcoding all candidates which are
+        available locally and pass all checks, without transcoding anything.
+
+        Only candidates whose torrent is already in the cache are included,
+        fetching the others would take `rate_limit` seconds each.
+        """
+        model = self.model
+        uncached = []
+
+        print("Fetching potential upload candidates from apollo...")
+        try:
+            candidates = self.cached_candidates(self.candidates(allowed_formats), uncached)
+            jobs = self.plan(candidates, model, check=True)
+        finally:
+            self.vetter.close()
+        print()
+        print(planner.plan_summary(jobs, model))
+        if uncached:
+            print()
+            print("{} candidates were skipped because their torrent info isn't cached yet. It is fetched and cached by a normal run.".format(len(uncached)))
+
+    @staticmethod
+    def check_log(torrent):
+        """
+        Check that the log of a torrent (if it has one) has a score of 100
+        and a valid checksum.
+        """
+        t = torrent["torrent"]
+        return not t["hasLog"] or (t["logScore"] == 100 and t["logChecksum"] == 1)
+
+    def budget_exhausted(self, job, model, start, budget_cpu, budget_time):
+        """
+        Check if `job` still fits into the remaining budget using the CPU
+        and wall time actually used so far.
+        """
+        if job.cpu is None:
+            return True
+        if budget_cpu is not None:
+            used = sum(r["utime"] + r["stime"] for r in self.usage.records)
+            if used + job.cpu > budget_cpu:
+                return True
+        if budget_time is not None:
+            elapsed = time.monotonic() - start
+            if elapsed + model.wall(job.info, job.cpu) > budget_time:
+                return True
+        return False
+
+    def process_release(self, tid, oformats, limit=None, gid=None):
         """
         Transcode and upload multiple formats for a single release group.
 
+        Every format is claimed with a lease first, formats claimed by
+        another process are skipped. (see `lease`)
+
         :param tid: ID of the source flac torrent.
         :param oformats: Output formats wich will be generated and uploaded.
         :param limit: Maximum number of torrents to upload.
+        :param gid: ID of the group of the torrent. If given the whole group
+                    is fetched if the torrent isn't cached yet.
 
         :returns: The number of torrents that where actually uploaded.
         """
+        leases = {}
+        for oformat in oformats:
+            claim = self.leases.acquire(tid, oformat.NAME)
+            if claim is None:
+                print("Skipping format {} of {}, it is done or claimed by another process.".format(oformat.NAME, tid))
+                self.metrics.inc("formats_skipped_total", reason="leased")
+            else:
+                leases[oformat] = claim
+        if not leases:
+            return 0
+
+        try:
+            return self.process_claimed_release(tid, leases, limit, gid)
+        finally:
+            for claim in leases.values():
+                claim.release()
+
+    def process_claimed_release(self, tid, leases, limit=None, gid=None):
+        """
+        Transcode and upload the formats of a release after claiming them.
+        (see `process_release`)
+
+        :param leases: A `dict` mapping the output formats to their leases.
+        """
+        oformats = list(leases)
         try:
-            torrent = self.api.get_torrent(tid)
+            with self.metrics.stage("get_torrent"):
+                torrent = self.api.get_torrent(tid, gid=gid)
+        except ApiUnavailableError as e:
+            # not a problem of this release, the next one may be cached
+            print("\tError: Requesting torrent info for {} failed. ({}) Skipping...".format(tid, e))
+            return 0
         except ApiError as e:
             msg = "\tError: Requesting torrent info for {} failed. ({})".format(tid, e)
             if self.continue_on_error:
@@ -122,49 +464,118 @@ class ApolloBetter:
             tid,
             ", ".join(f.NAME for f in oformats)))
 
-        path = util.find_dir(torrent["torrent"]["filePath"], self.search_dirs)
+        with self.metrics.stage("vet"):
+            verdict = self.vetter.result(tid, torrent)
+        path = verdict.path
         if path is None:
             return 0
         print("\tFound {}.".format(path))
 
-        if (torrent["torrent"]["hasLog"]
-                and (torrent["torrent"]["logScore"] != 100
-                        or torrent["torrent"]["logChecksum"] != 1)):
+        if not self.check_log(torrent):
             print("\tTorrent has a log file but its score is below 100 or it has a invalid checksum. Skipping...")
             return 0
 
         if self.unique_groups:
-            group = self.api.get_group(torrent["group"]["id"])
+            try:
+                with self.metrics.stage("get_group"):
+                    group = self.api.get_group(torrent["group"]["id"], GROUP_MAX_AGE)
+            except ApiUnavailableError as e:
+                # the next release may be in a group fetched recently
+                print("\tError: Couldn't check the torrents of the group. ({}) Skipping...".format(e))
+                return 0
+            except ApiError as e:
+                msg = "\tError: Couldn't check the torrents of the group. ({})".format(e)
+                if self.continue_on_error:
+                    print(msg)
+                    return 0
+                else:
+                    raise ApolloBetterError(msg)
             if any(t["username"] == self.api.username for t in group["torrents"]):
                 print("\tYou already own a torrent in this group, skipping... (--unique-groups)")
                 return 0
 
-        msg = util.check_source_release(path, torrent)
-        if msg is not None:
-            print("\t{} Skipping release...".format(msg))
+        if verdict.msg is not None:
+            print("\t{} Skipping release...".format(verdict.msg))
             return 0
 
+        if self.verify_cache is not None:
+            with self.metrics.stage("verify"):
+                # files tested ahead by `verify_ahead` aren't tested again
+                for f, key, ok, msg in self.vetter.verify_result(tid):
+                    self.verify_cache.set(f, ok, msg, key)
+                msg = verify.verify_release(path, self.verify_cache,
+                                            io_jobs=self.io_jobs,
+                                            limiter=self.limiter)
+            if msg is not None:
+                print("\t{} Skipping release...".format(msg))
+                return 0
+
+        if self.spectral_check is not None:
+            import spectral
+            with self.metrics.stage("spectral_check"):
+                msg = spectral.check_release(path)
+            if msg is not None:
+                if self.spectral_check == "skip":
+                    print("\t{} Skipping release...".format(msg))
+                    return 0
+                print("\tWarning: {}".format(msg))
+
+        info = verdict.info
+
         nuploaded = 0
         for oformat in oformats:
             if limit is not None and nuploaded >= limit:
                 break
 
-            if self.process_format(torrent, path, oformat):
+            if self.process_format(torrent, path, oformat, info, leases[oformat]):
                 nuploaded += 1
 
         return nuploaded
 
-    def process_format(self, torrent, path, oformat):
+    def admit(self, path, info, oformat):
+        """
+        Reserve the disk space needed to transcode `path` to `oformat` in
+        the output directory and the scratch directory.
+
+        :param info: The `planner.ReleaseInfo` of the source. If it is
+                     `None` nothing is reserved.
+
+        :returns: A `contextlib.ExitStack` releasing the reservations on
+                  exit or `None` if there isn't enough space.
+        """
+        stack = contextlib.ExitStack()
+        if info is None:
+            return stack
+        size = admission.estimate_transcode_size(path, info, oformat, self.model)
+        scratch = admission.estimate_torrent_size(size, info.tracks)
+        if self.stage:
+            # the transcode is created in the scratch directory first
+            scratch += size
+        for space, nbytes in ((self.output_space, size),
+                              (self.scratch_space, scratch)):
+            reservation = space.reserve(nbytes)
+            if reservation is None:
+                stack.close()
+                return None
+            stack.enter_context(reservation)
+        return stack
+
+    def process_format(self, torrent, path, oformat, info=None, claim=None):
         """
         Transcode and upload a single format.
 
         :param torrent: A `dict` as returned by `api.get_torrent`.
         :param path: A `Path` to the directory containing the source flac files.
         :param oformat: The output format.
+        :param info: The `planner.ReleaseInfo` of the source, used to
+                     estimate the needed disk space.
+        :param claim: The `lease.Lease` of the format or `None`.
 
         :returns: `True` on success, `False` otherwise.
         """
         print("\tProcessing Format {}:".format(oformat.NAME))
+        if claim is None:
+            claim = lease.NullLease()
 
         transcode_dir = util.generate_transcode_name(torrent, oformat)
         dst_path = self.output_dir / transcode_dir
@@ -179,9 +590,52 @@ class ApolloBetter:
             else:
                 raise ApolloBetterError(msg)
 
+        # better.php may be hours old by now, don't waste time transcoding
+        # a format which was uploaded in the meantime.
+        try:
+            with self.metrics.stage("get_group"):
+                group = self.api.get_group(torrent["group"]["id"], DEDUPE_MAX_AGE)
+        except ApiError as e:
+            print("\t\tWarning: Couldn't check for existing formats. ({})".format(e))
+        else:
+            if oformat in util.existing_formats(group, torrent):
+                print("\t\tThis format was already uploaded, skipping...")
+                self.metrics.inc("formats_skipped_total", reason="exists")
+                return False
+
+        reservations = self.admit(path, info, oformat)
+        if reservations is None:
+            print("\t\tNot enough disk space, holding back...")
+            self.metrics.inc("formats_skipped_total", reason="disk_space")
+            self.held_back.append((torrent["torrent"]["id"], torrent["group"]["id"], oformat))
+            return False
+        with reservations:
+            return self.transcode_format(torrent, path, oformat, dst_path, tfile, tfile_new, claim)
+
+    def transcode_format(self, torrent, path, oformat, dst_path, tfile, tfile_new, claim):
+        """
+        Transcode, create the torrent file and upload. (see `process_format`)
+
+        In staging mode the transcode and the torrent file are created in
+        the scratch directory and the finished transcode is moved to
+        `dst_path` before uploading.
+        """
+        work_path = dst_path
+        if self.stage:
+            work_path = Path(self.tmp.name) / dst_path.name
+
+        njobs, limiter = None, self.limiter
+        if self.controller is not None:
+            njobs, limiter = self.controller.max_jobs, self.controller
+
         print("\t\tTranscoding...")
         try:
-            transcode(path, dst_path, oformat)
+            if self.stage and dst_path.exists():
+                raise TranscodeError("Destination directory ({}) allready exists".format(dst_path))
+            with self.metrics.stage("transcode"):
+                results = transcode(path, work_path, oformat,
+                                    njobs=njobs, io_jobs=self.io_jobs,
+                                    limiter=limiter, backend=self.backend)
         except TranscodeError as e:
             if self.continue_on_error:
                 print("\t\tError: ", e)
@@ -189,17 +643,65 @@ class ApolloBetter:
             else:
                 raise e
 
+        for track, info, result in results:
+            size = (work_path / track).with_suffix(oformat.SUFFIX).stat().st_size
+            self.usage.add(torrent["torrent"]["id"], oformat.NAME,
+                           str(track), info.length, result,
+                           rate=info.sample_rate, size=size)
+
         print("\t\tCreating torrent file...")
-        util.create_torrent_file(tfile, dst_path, ANNOUNCE_URL,
-                                 self.api.passkey, "APL", overwrite=True)
+        with self.metrics.stage("create_torrent"):
+            util.create_torrent_file(tfile, work_path, ANNOUNCE_URL,
+                                     self.api.passkey, "APL", overwrite=True)
+
+        if self.stage:
+            print("\t\tMoving transcode to the output directory...")
+            try:
+                with self.metrics.stage("publish"):
+                    util.publish_dir(work_path, dst_path)
+            except OSError as e:
+                shutil.rmtree(work_path, ignore_errors=True)
+                os.remove(tfile)
+                msg = "\t\tError: Moving the transcode to {} failed. ({})".format(dst_path, e)
+                if self.continue_on_error:
+                    print(msg)
+                    return False
+                else:
+                    raise ApolloBetterError(msg)
 
-        print("\t\tUploading torrent...")
         description = util.generate_description(
                 torrent["torrent"]["id"],
                 sorted(path.glob("**/*" + formats.FormatFlac.SUFFIX))[0],
-                oformat)
+                oformat,
+                self.backend)
+        return self.upload(torrent, oformat, dst_path, tfile, tfile_new, description, claim)
+
+    def upload(self, torrent, oformat, dst_path, tfile, tfile_new, description, claim):
+        """
+        Upload a finished transcode and move its torrent file to the
+        torrent directory.
+
+        If the site is unavailable the upload is added to `pending_uploads`
+        and retried by `retry_pending_uploads`. Nothing is uploaded if the
+        lease `claim` was lost to another process.
+
+        :returns: `True` on success, `False` otherwise.
+        """
+        if claim.lost:
+            print("\t\tAnother process took over this format, removing the transcode...")
+            shutil.rmtree(dst_path)
+            os.remove(tfile)
+            return False
+
+        print("\t\tUploading torrent...")
         try:
-            self.api.add_format(torrent, oformat, tfile, description)
+            with self.metrics.stage("upload"):
+                self.api.add_format(torrent, oformat, tfile, description)
+        except ApiUnavailableError as e:
+            print("\t\tThe site is unavailable, trying again later. ({})".format(e))
+            claim.keep = True
+            self.pending_uploads.append((torrent, oformat, dst_path, tfile, tfile_new, description, claim))
+            return False
         except ApiError as e:
             shutil.rmtree(dst_path)
             os.remove(tfile)
@@ -209,11 +711,73 @@ class ApolloBetter:
             else:
                 raise e
 
+        self.finish_upload(oformat, tfile, tfile_new, claim)
+        return True
+
+    def finish_upload(self, oformat, tfile, tfile_new, claim):
         print("\t\tMoving torrent file...")
         shutil.copyfile(tfile, tfile_new)
+        claim.finish()
+        self.metrics.inc("uploads_total", format=oformat.NAME)
 
         print("\t\tDone.")
-        return True
+
+    def retry_pending_uploads(self, limit=None):
+        """
+        Retry the uploads which failed because the site was unavailable,
+        once the circuit breaker of the api lets requests through again.
+
+        A failed upload may have reached the site anyway, so the group is
+        checked first and the upload is only sent again if the format isn't
+        there. Transcodes which still can't be uploaded are removed.
+
+        :param limit: Maximum number of torrents to upload.
+
+        :returns: The number of torrents that where uploaded.
+        """
+        pending, self.pending_uploads = self.pending_uploads, []
+        if pending:
+            print("Retrying {} uploads which failed because the site was unavailable...".format(len(pending)))
+        nuploaded = 0
+        for i, (torrent, oformat, dst_path, tfile, tfile_new, description, claim) in enumerate(pending):
+            if limit is not None and nuploaded >= limit:
+                self.pending_uploads.extend(pending[i:])
+                break
+            print("\t{} {}:".format(dst_path.name, oformat.NAME))
+            wait = self.api.breaker.remaining()
+            if wait > 0:
+                print("\t\tWaiting {:.0f}s for the site...".format(wait))
+                time.sleep(wait)
+            try:
+                with self.metrics.stage("get_group"):
+                    group = self.api.get_group(torrent["group"]["id"])
+            except ApiError as e:
+                print("\t\tError: Couldn't check if the upload reached the site. ({})".format(e))
+                self.pending_uploads.append(pending[i])
+                continue
+            claim.keep = False
+            if oformat in util.existing_formats(group, torrent, self.api.username):
+                print("\t\tThe upload reached the site.")
+                self.finish_upload(oformat, tfile, tfile_new, claim)
+                nuploaded += 1
+            elif oformat in util.existing_formats(group, torrent):
+                print("\t\tThis format was uploaded by someone else in the meantime, removing the transcode...")
+                shutil.rmtree(dst_path)
+                os.remove(tfile)
+            elif self.upload(torrent, oformat, dst_path, tfile, tfile_new, description, claim):
+                nuploaded += 1
+            claim.release()
+
+        if self.pending_uploads:
+            print("{} transcodes couldn't be uploaded, removing them:".format(len(self.pending_uploads)))
+            for torrent, oformat, dst_path, tfile, tfile_new, description, claim in self.pending_uploads:
+                print("\t{}".format(dst_path))
+                shutil.rmtree(dst_path)
+                os.remove(tfile)
+                claim.keep = False
+                claim.release()
+            self.pending_uploads = []
+        return nuploaded
 
 def main():
     config = configparser.ConfigParser()
@@ -226,11 +790,47 @@ def main():
     parser.add_argument("-l", "--limit", type=int, help="Maximum number of torrents to upload")
     parser.add_argument("-u", "--unique-groups", action="store_true", help="Upload only into groups you do not yet have a single torrent in.")
     parser.add_argument("--continue-on-error", action="store_true", help="Continue with the next torrent instead of aborting on recoverable errors.")
+    parser.add_argument("--spectral-check", choices=("warn", "skip"), help="Analyze the spectrum of the source before transcoding and warn about or skip releases that look like lossy sources or upsamples. (Requires numpy)")
+    parser.add_argument("--usage-file", type=Path, help="Write the CPU and wall time of all transcode processes as json to this file.")
+    parser.add_argument("--metrics-file", type=Path, help="Export counters and stage timings in the Prometheus text format to this file.")
+    parser.add_argument("--profile", type=Path, metavar="FILE", help="Sample the python stacks of all threads during the run, write them to FILE in the collapsed stack format (e.g. for flamegraph.pl) and print a summary per stage and function.")
+    parser.add_argument("--metrics-log", type=Path, help="Append the stage timings of every release as a json line to this file.")
+    parser.add_argument("--order", choices=("page", "throughput"), default="page", help="Process the candidates in the order of better.php (page) or the ones with the most uploads per estimated CPU time first (throughput). (Default: page)")
+    parser.add_argument("--budget-cpu", type=float, metavar="SECONDS", help="Only process candidates whose estimated transcode CPU time fits into this many seconds.")
+    parser.add_argument("--budget-time", type=float, metavar="SECONDS", help="Only process candidates whose estimated transcode time fits into this many seconds of wall time.")
+    parser.add_argument("--plan", action="store_true", help="Only print the number of torrents, audio duration, estimated CPU time and output size per format of all candidates, don't transcode anything.")
+    parser.add_argument("--calibrate", action="store_true", help="Measure the CPU cost of the transcode tools on this machine with a short benchmark and use it for --plan, --order and the budgets from now on.")
+    parser.add_argument("--calibrate-from", type=Path, metavar="USAGE_FILE", help="Calibrate the cost estimates from a file written by --usage-file and use them from now on.")
+    parser.add_argument("--min-free", type=util.parse_size, default=0, metavar="SIZE", help="Hold back transcodes which would leave less than SIZE (e.g. 10G) free in the output directory.")
+    parser.add_argument("--scratch-dir", type=Path, help="Where to put temporary files. (Default: the system temp directory)")
+    parser.add_argument("--scratch-budget", type=util.parse_size, metavar="SIZE", help="Maximum size of the temporary files (e.g. 500M).")
+    parser.add_argument("--stage", action="store_true", help="Transcode and create the torrent in the scratch directory and move the finished transcode to the output directory at once. Recommended if the output directory is on a network file system.")
+    parser.add_argument("--io-jobs", type=int, metavar="N", help="Read the source files ahead with N sequential readers and start every transcode only when its source is in the page cache. Helps with slow storage like spinning disks. (Default: no read ahead)")
+    parser.add_argument("--backend", choices=sorted(backends.BACKENDS), default=backends.CliBackend.NAME, help="How FLAC files are decoded: 'cli' pipes the output of flac into the encoder, 'soundfile' decodes them inside apollo-cli which saves a process per track. Both produce the same files. (Default: cli)")
+    parser.add_argument("--shared", action="store_true", help="Coordinate with other apollo-cli processes using the same output directory, e.g. on other hosts over NFS, so every format is only transcoded by one of them.")
+    parser.add_argument("--vet-jobs", type=int, metavar="N", help="Number of worker processes which find and check upcoming releases in the background. 0 checks every release right before transcoding it. (Default: number of CPU cores)")
+    parser.add_argument("--no-verify", action="store_true", help="Don't test the FLAC files of a release with 'flac -t' before transcoding it. Files are only tested once as long as they don't change.")
+    parser.add_argument("--nice", type=int, help="Increase the nice value of apollo-cli and all transcodes by this much.")
+    parser.add_argument("--ionice", choices=sorted(scheduling.IOPRIO_CLASSES), help="I/O scheduling class of apollo-cli and all transcodes.")
+    parser.add_argument("--ionice-level", type=int, choices=range(8), default=4, metavar="0-7", help="I/O priority within the --ionice class. (Default: 4)")
+    parser.add_argument("--cpus", type=scheduling.parse_cpus, help="Only run on these CPUs, e.g. 0-3,6.")
+    parser.add_argument("--cgroup", help="Join this cgroup v2 (it must exist and be writable) with all transcodes.")
+    parser.add_argument("--cpu-quota", type=float, metavar="CPUS", help="Limit the CPU time of the --cgroup to this many CPUs, e.g. 2.5.")
+    parser.add_argument("--adapt-to-load", action="store_true", help="Run fewer transcodes in parallel while other processes cause load.")
+    parser.add_argument("--adaptive-jobs", action="store_true", help="Measure the transcoded seconds of audio per second and adjust the number of parallel transcodes to the highest throughput, between --min-jobs and --max-jobs. The current number is exported by --metrics-file.")
+    parser.add_argument("--min-jobs", type=int, default=1, metavar="N", help="Lower bound for --adaptive-jobs. (Default: 1)")
+    parser.add_argument("--max-jobs", type=int, metavar="N", help="Upper bound for --adaptive-jobs. (Default: twice the number of CPU cores)")
     parser.add_argument("-v2", "--format-v2", action="store_true")
     parser.add_argument("-v0", "--format-v0", action="store_true")
     parser.add_argument("-320", "--format-320", action="store_true")
     args = parser.parse_args()
 
+    if args.spectral_check is not None:
+        # numpy takes long to import, only load it when it's needed
+        import spectral
+        if not spectral.available():
+            parser.error("--spectral-check requires numpy.")
+
     allowed_formats = set()
     if args.format_v2:
         allowed_formats.add(formats.FormatV2)
@@ -241,6 +841,53 @@ def main():
     if not allowed_formats:
         allowed_formats = formats.FORMATS
 
+    try:
+        backend = backends.get_backend(args.backend)
+    except backends.BackendError as e:
+        parser.error(str(e))
+
+    if args.io_jobs is not None and args.io_jobs < 1:
+        parser.error("--io-jobs must be at least 1.")
+    if args.vet_jobs is not None and args.vet_jobs < 0:
+        parser.error("--vet-jobs must be at least 0.")
+
+    if args.adaptive_jobs and args.adapt_to_load:
+        parser.error("--adaptive-jobs and --adapt-to-load can't be combined.")
+
+    if args.cpu_quota is not None and args.cgroup is None:
+        parser.error("--cpu-quota requires --cgroup.")
+    try:
+        scheduling.apply(args.nice, args.ionice, args.ionice_level, args.cpus,
+                         args.cgroup, args.cpu_quota)
+    except scheduling.SchedulingError as e:
+        parser.error(str(e))
+
+    model_path = util.cache_dir() / "cost_model.json"
+    try:
+        if args.calibrate:
+            print("Calibrating the cost model...")
+            model = planner.calibrate()
+            model.save(model_path)
+        elif args.calibrate_from is not None:
+            model = planner.CostModel.from_usage(args.calibrate_from)
+            model.save(model_path)
+        elif model_path.exists():
+            model = planner.CostModel.load(model_path)
+        else:
+            model = planner.CostModel()
+    except planner.PlannerError as e:
+        parser.error(str(e))
+
+    metrics = None
+    if args.metrics_file is not None or args.metrics_log is not None:
+        metrics = Metrics(args.metrics_file, args.metrics_log)
+
+    sampler = None
+    if args.profile is not None:
+        import sampler as sampling
+        sampler = sampling.Sampler()
+        metrics = sampling.ProfiledMetrics(metrics if metrics is not None else NullMetrics(), sampler)
+
     better = ApolloBetter(
         config["apollo"]["username"],
         config["apollo"]["password"],
@@ -249,9 +896,40 @@ def main():
         args.torrent_dir,
         args.unique_groups,
         config["DEFAULT"]["torrent_cache"],
-        args.continue_on_error)
-
-    nuploaded = better.run(allowed_formats=allowed_formats, limit=args.limit)
+        args.continue_on_error,
+        args.spectral_check,
+        args.usage_file,
+        metrics,
+        session_path=config["DEFAULT"].get("session_cache"),
+        model=model,
+        scratch_dir=args.scratch_dir,
+        scratch_budget=args.scratch_budget,
+        min_free=args.min_free,
+        stage=args.stage,
+        io_jobs=args.io_jobs,
+        limiter=scheduling.LoadLimiter() if args.adapt_to_load else None,
+        backend=backend,
+        verify_cache=None if args.no_verify else verify.VerifyCache(util.cache_dir() / "verified.json"),
+        vet_jobs=args.vet_jobs,
+        leases=lease.LeaseManager(args.output_dir / ".apollo-leases") if args.shared else None,
+        controller=scheduling.ConcurrencyController(args.min_jobs, args.max_jobs, metrics=metrics) if args.adaptive_jobs else None)
+
+    if sampler is not None:
+        sampler.start()
+    try:
+        if args.plan:
+            better.show_plan(allowed_formats)
+            return
+        nuploaded = better.run(allowed_formats=allowed_formats, limit=args.limit,
+                               order=args.order, budget_cpu=args.budget_cpu,
+                               budget_time=args.budget_time)
+    finally:
+        better.api.close()
+        if sampler is not None:
+            sampler.stop()
+            sampler.write_collapsed(args.profile)
+            print()
+            print(sampler.summary())
 
     print("\nFinished")
     print("Uploaded {} torrents.".format(nuploaded))
@@ -0,0 +1,509 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+asyncio client for the apollo.rip API.
+
+`apolloapi.ApolloApi` is a synchronous wrapper around this client.
+"""
+
+from apolloapi import (ApiError, ApiUnavailableError, CircuitBreaker,
+                       TorrentCache, BetterParser, SITE_URL, USER_AGENT,
+                       CONNECT_TIMEOUT, READ_TIMEOUT, MAX_RETRIES,
+                       PAGE_CHUNK_SIZE, backoff_delay, decode_json,
+                       parse_response, upload_data)
+from metrics import NullMetrics
+import formats
+
+from http.cookies import SimpleCookie
+from urllib.parse import urljoin
+import asyncio
+import collections
+import contextvars
+import json
+import os
+import time
+
+import aiohttp
+from yarl import URL
+
+# A response whose body has been read, see `AsyncApolloApi._request`.
+Response = collections.namedtuple("Response", ("status", "headers", "body"))
+
+# Set in the tasks started by `AsyncApolloApi.prefetch`. Their waits are not
+# recorded as stages, they would be added to whatever release is processed
+# at that time.
+_background = contextvars.ContextVar("background", default=False)
+
+class AsyncApolloApi:
+    """
+    Asynchronous client for the apollo.rip API.
+
+    Many requests can be in flight at the same time, they share a pool of
+    keep-alive connections, the rate limit and the circuit breaker.
+    Concurrent identical API requests (e.g. a prefetch and a caller asking
+    for the same group) are merged into a single request.
+
+    Use it as an async context manager or call `close` when done.
+    """
+    def __init__(self, cache_path=None, site_url=SITE_URL, rate_limit=2,
+                 session_path=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 retries=MAX_RETRIES, breaker=None, connections=4):
+        """
+        Constructor
+
+        :param cache_path: Path of the json file used by the `TorrentCache`.
+        :param site_url: Base URL of the site. Only useful for testing.
+        :param rate_limit: Minimum time between two requests in seconds.
+        :param session_path: Path of a json file in which the session
+                             cookies and account data are kept between runs.
+        :param timeout: Tuple of the connect and read timeout in seconds.
+        :param retries: Number of retries of failed idempotent requests.
+        :param breaker: A `CircuitBreaker` or `None` for the default one.
+        :param connections: Maximum number of open connections.
+        """
+        self.authenticated = False
+        self.session_path = session_path
+        # `False` while using a session loaded from `session_path` which
+        # hasn't been accepted by the server yet.
+        self.session_verified = False
+        self._credentials = None
+        self.site_url = site_url
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.retries = retries
+        self.connections = connections
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.last_request = time.time()
+        self.cache = TorrentCache(cache_path)
+        self.metrics = NullMetrics()
+        self.session = None
+        self._inflight = {}
+        self._prefetching = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+        return False
+
+    async def close(self):
+        for task in list(self._prefetching):
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _session(self):
+        # The session and the locks must be created inside the event loop.
+        if self.session is None:
+            connect, read = self.timeout
+            self.session = aiohttp.ClientSession(
+                    headers={"User-Agent": USER_AGENT},
+                    # also keep cookies of plain IP addresses (e.g. a local test server)
+                    cookie_jar=aiohttp.CookieJar(unsafe=True),
+                    connector=aiohttp.TCPConnector(limit=self.connections),
+                    timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+            self._lock = asyncio.Lock()
+            self._login_lock = asyncio.Lock()
+            self._prefetch_lock = asyncio.Lock()
+        return self.session
+
+    def _observe(self, stage, seconds):
+        if not _background.get():
+            self.metrics.observe(stage, seconds)
+
+    async def login(self, username, password):
+        """
+        Authenticate with the apollo server.
+
+        If `session_path` contains a session of `username` it is used without
+        sending any request. It is verified by the first request and a full
+        login is done if the server rejects it.
+
+        :raises ApiError: If the login failed.
+        """
+        self._session()
+        self._credentials = (username, password)
+        if self._load_session(username):
+            return
+        await self._login()
+
+    async def _login(self):
+        username, password = self._credentials
+        self.session.cookie_jar.clear()
+        r = await self._request("POST", self.site_url + "/login.php",
+                                data={"username": username,
+                                      "password": password,
+                                      "login": "Log in"},
+                                allow_redirects=False)
+        if r.status == 302 and r.headers["location"] != "login.php":
+            self.session_verified = True
+            r = await self.get_index()
+            if r is not None:
+                self._set_index(r)
+                self._save_session(username)
+                return
+
+        raise ApiError("Login failed.")
+
+    def _set_index(self, r):
+        self.username = r["username"]
+        self.uid = r["id"]
+        self.authkey = r["authkey"]
+        self.passkey = r["passkey"]
+        self.authenticated = True
+
+    def _load_session(self, username):
+        """
+        Load the session of `username` from `session_path`.
+
+        :returns: `True` if a session was loaded.
+        """
+        if self.session_path is None:
+            return False
+        try:
+            with open(self.session_path, "r") as f:
+                data = json.load(f)
+            if data["site_url"] != self.site_url or data["login"] != username:
+                return False
+            cookies = SimpleCookie()
+            for c in data["cookies"]:
+                cookies[c["name"]] = c["value"]
+                cookies[c["name"]]["path"] = c["path"]
+            # all cookies come from the site, bind them to its host
+            self.session.cookie_jar.update_cookies(cookies, URL(self.site_url))
+            self._set_index(data["index"])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.session.cookie_jar.clear()
+            return False
+        self.session_verified = False
+        return True
+
+    def _save_session(self, username):
+        """
+        Save the session to `session_path`. Only the owner can read it.
+        """
+        if self.session_path is None:
+            return
+        data = {
+            "site_url": self.site_url,
+            "login": username,
+            "cookies": [{"name": c.key, "value": c.value,
+                         "domain": c["domain"], "path": c["path"]}
+                        for c in self.session.cookie_jar],
+            "index": {"username": self.username, "id": self.uid,
+                      "authkey": self.authkey, "passkey": self.passkey},
+        }
+        fd = os.open(self.session_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            # O_CREAT doesn't change the mode of an existing file
+            os.fchmod(f.fileno(), 0o600)
+            json.dump(data, f)
+
+    async def _session_rejected(self, r):
+        """
+        Check if the server rejected a loaded session by redirecting to the
+        login page and do a full login in that case.
+
+        :returns: `True` if the request has to be repeated.
+        """
+        if (r.status in (301, 302, 303)
+                and "login.php" in r.headers.get("location", "")
+                and not self.session_verified
+                and self._credentials is not None):
+            # concurrent requests are rejected together, log in only once
+            async with self._login_lock:
+                if not self.session_verified:
+                    await self._login()
+            return True
+        if r.status == 200:
+            self.session_verified = True
+        return False
+
+    async def _request(self, method, url, retry=True, read=None, **kwargs):
+        """
+        Send a request through the circuit breaker and read its response.
+
+        Connection errors, timeouts, responses cut off or garbled while they
+        are read and 5xx responses are retried with jittered exponential
+        backoff if `retry` is set. Only set it for requests which can be
+        repeated safely.
+
+        :param read: A coroutine function reading the body of a response
+                     with a status code below 500. By default the whole
+                     body is returned as `bytes`.
+        :param kwargs: Passed to `aiohttp.ClientSession.request`.
+
+        :returns: A `Response`.
+        :raises ApiUnavailableError: If the request failed or the breaker
+                                     is open.
+        """
+        if read is None:
+            read = aiohttp.ClientResponse.read
+        attempts = self.retries + 1 if retry else 1
+        error = None
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                self.metrics.inc("api_rejected_total")
+                raise ApiUnavailableError("The site is unavailable, no requests are sent for {:.0f}s. ({})".format(
+                    self.breaker.remaining(), error or "earlier requests failed"))
+            if attempt > 0:
+                self.metrics.inc("api_retries_total")
+                delay = backoff_delay(attempt)
+                await asyncio.sleep(delay)
+                self._observe("retry_wait", delay)
+                await self._wait_rate_limit()
+            try:
+                async with self._session().request(method, url, **kwargs) as r:
+                    if r.status < 500:
+                        body = await read(r)
+                        self.breaker.success()
+                        return Response(r.status, r.headers, body)
+                    error = "status code {}".format(r.status)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            self.metrics.inc("api_failures_total")
+        self.breaker.failure()
+        raise ApiUnavailableError("Request to {} failed. ({})".format(url, error))
+
+    async def _wait_rate_limit(self):
+        """
+        Wait till the next request may be sent.
+
+        Requests are released one by one in the order they called this.
+        """
+        self._session()
+        start = time.perf_counter()
+        async with self._lock:
+            delay = self.last_request + self.rate_limit - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.last_request = time.time()
+        self._observe("rate_limit_wait", time.perf_counter() - start)
+
+    async def _api_request(self, action, **kwargs):
+        """
+        Send a request to ajax.php.
+
+        Identical concurrent requests share a single request.
+        """
+        kwargs = {k: str(v) for k, v in kwargs.items()}
+        key = (action, tuple(sorted(kwargs.items())))
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._send_api_request(action, **kwargs))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        # shield the shared request from the cancellation of a single caller
+        return await asyncio.shield(future)
+
+    async def _send_api_request(self, action, **kwargs):
+        await self._wait_rate_limit()
+        self.metrics.inc("api_requests_total", action=action)
+
+        params = {"action": action}
+        params.update(kwargs)
+        r = await self._request("GET", self.site_url + "/ajax.php",
+                                params=params, allow_redirects=False)
+        if await self._session_rejected(r):
+            return await self._send_api_request(action, **kwargs)
+        if r.status == 200:
+            return parse_response(decode_json(r.body))
+        else:
+            raise ApiError("API request failed with status code {}".format(r.status))
+
+    async def get_better_snatched(self):
+        """
+        Get the transcode candidates from better.php.
+
+        :returns: An async generator yielding a `dict` for every candidate.
+        :raises ApiError: If a page couldn't be fetched. The candidates of
+                          the pages before were yielded already.
+        """
+        async for candidates in self.better_pages():
+            for c in candidates:
+                yield c
+
+    async def better_pages(self):
+        """
+        Get the transcode candidates from better.php page by page.
+
+        Every page is read completely before its candidates are yielded,
+        so no connection is kept open while the caller works on them. The
+        next page is only fetched when the candidates of the previous one
+        are used up.
+
+        :returns: An async generator yielding a `list` of `dict`s for
+                  every page.
+        """
+        if not self.authenticated:
+            return
+
+        url = self.site_url + "/better.php?method=snatch"
+        first_page = True
+        while url is not None:
+            if not first_page:
+                await self._wait_rate_limit()
+            first_page = False
+            candidates, next_page = await self._fetch_better_page(url)
+
+            yield candidates
+            url = urljoin(self.site_url + "/", next_page) if next_page else None
+
+    async def _fetch_better_page(self, url):
+        """
+        Fetch and parse a single better.php page.
+
+        The page is parsed while it is read, so only the candidates and not
+        the html are kept in memory.
+
+        :returns: A tuple like `apolloapi.parse_better`.
+        :raises ApiError:
+        """
+        async def read(r):
+            if r.status != 200:
+                return None
+            parser = BetterParser()
+            candidates = []
+            async for chunk in r.content.iter_chunked(PAGE_CHUNK_SIZE):
+                candidates.extend(parser.feed(chunk))
+            candidates.extend(parser.close())
+            return candidates, parser.next_page
+
+        r = await self._request("GET", url, read=read, allow_redirects=False)
+        if await self._session_rejected(r):
+            r = await self._request("GET", url, read=read, allow_redirects=False)
+        if r.status != 200:
+            raise ApiError("Couldn't fetch better snatched. (Statuscode: {})".format(r.status))
+        return r.body
+
+    async def get_torrent(self, tid, caching=True, gid=None):
+        """
+        Get information about a torrent.
+
+        :param tid: ID of the torrent.
+        :param caching: Use the `TorrentCache`.
+        :param gid: ID of the group of the torrent if known. If the torrent
+                    is not cached the whole group is fetched which also
+                    caches all other torrents of the group.
+        """
+        if not caching:
+            return await self._api_request("torrent", id=tid)
+        tid = str(tid)
+        if self.cache.cached(tid) is None and gid is not None:
+            await self.get_group(gid)
+        t = self.cache.cached(tid)
+        if t is None:
+            t = await self._api_request("torrent", id=tid)
+            if t:
+                self.cache.torrents[tid] = t
+        return t
+
+    async def get_group(self, gid, max_age=None):
+        """
+        Get information about a torrent group and all its torrents.
+
+        All torrents of the group are added to the `TorrentCache`.
+
+        :param gid: ID of the group.
+        :param max_age: If not `None` a group fetched during the last
+                        `max_age` seconds is returned without a new request.
+        """
+        if max_age is not None:
+            group = self.cache.get_group(gid, max_age)
+            if group is not None:
+                return group
+        group = await self._api_request("torrentgroup", id=gid)
+        self.cache.add_group(group)
+        return group
+
+    async def get_index(self):
+        return await self._api_request("index")
+
+    def prefetch(self, tid, gid):
+        """
+        Fetch the group `gid` of the torrent `tid` into the cache in the
+        background unless the torrent is cached already.
+
+        Prefetches are sent one at a time, so other requests wait for at
+        most one of them. Errors are ignored, the torrent is fetched again
+        when it is needed. Must be called from the event loop.
+        """
+        task = asyncio.ensure_future(self._prefetch(tid, gid))
+        self._prefetching.add(task)
+        task.add_done_callback(self._prefetching.discard)
+
+    async def _prefetch(self, tid, gid):
+        _background.set(True)
+        self._session()
+        async with self._prefetch_lock:
+            if self.cache.cached(tid) is not None:
+                return
+            try:
+                await self.get_group(gid)
+            except ApiError:
+                pass
+
+    async def add_format(self, torrent, format, tfile, description=""):
+        """
+        Upload a transcode.
+
+        The upload is never repeated automatically. If it raises an
+        `ApiUnavailableError` it may still have reached the site, check
+        the group before trying again.
+        """
+        if format not in formats.FORMATS:
+            return False # TODO indicate "not a valid format" error
+
+        gid = torrent["group"]["id"]
+
+        async def upload():
+            # the authkey changes if a rejected session was replaced
+            data = upload_data(torrent, format, self.authkey, description)
+            # quote_fields=False sends the utf-8 file name as is, the site
+            # doesn't understand the RFC 2231 encoding used otherwise.
+            form = aiohttp.FormData(quote_fields=False)
+            for k, v in data.items():
+                form.add_field(k, str(v))
+            with tfile.open("rb") as f:
+                form.add_field("file_input", f,
+                               filename=tfile.name,
+                               content_type="application/x-bittorrent")
+                return await self._request("POST", self.site_url + "/upload.php",
+                                           retry=False,
+                                           params={"groupid": str(gid)},
+                                           data=form,
+                                           allow_redirects=False)
+
+        try:
+            r = await upload()
+            if await self._session_rejected(r):
+                r = await upload()
+        finally:
+            # the group has changed or may have changed
+            self.cache.groups.pop(str(gid), None)
+
+        if r.status != 302 or "login.php" in r.headers.get("location", ""):
+            raise ApiError("Couldn't add format. (Status code: {})".format(r.status))
@@ -0,0 +1,189 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Backends running the decode and encode steps of a transcode.
+
+`CliBackend` pipes the output of the `flac` or `sox` command line tools into
+the encoder. `SoundfileBackend` decodes the FLAC files inside this process
+with libsndfile and writes the samples directly to the stdin of the encoder,
+saving one process per track. Both feed the encoder the same WAV stream, so
+the encoded files are identical.
+
+A backend creates the `pipeline.Pipeline` of every track and describes the
+process it uses for the release description.
+"""
+
+from pipeline import Pipeline
+import transcode
+import util
+
+# soundfile is optional and imported in the functions which need it.
+
+import struct
+import sys
+
+# Number of frames decoded at once by `FlacSource`.
+BLOCK_FRAMES = 64 * 1024
+
+class BackendError(Exception):
+    pass
+
+class CliBackend:
+    """
+    Decodes with `flac` or resamples with `sox`, see
+    `transcode.generate_transcode_cmds`.
+    """
+    NAME = "cli"
+
+    def pipeline(self, src, dst, target_format, resample=None):
+        """
+        Create the pipeline transcoding a single file.
+
+        :param src: `Path` to the FLAC file.
+        :param dst: `Path` to the output file.
+        :param target_format: The output format. (see `formats`)
+        :param resample: The target rate or `None`.
+                         (see `transcode.compute_resample`)
+        """
+        cmds = transcode.generate_transcode_cmds(src, dst, target_format, resample)
+        return Pipeline(cmds, inputs=[src])
+
+    def describe(self, src, dst, target_format, resample=None):
+        """
+        Describe the process used to transcode a file.
+
+        :param src: Name of the FLAC file.
+        :param dst: Name of the output file.
+
+        :returns: A tuple `(process, versions)` with the process as a shell
+                  like pipeline and a `list` of the versions of the tools.
+        """
+        cmds = transcode.generate_transcode_cmds(src, dst, target_format, resample)
+        process = " | ".join(" ".join(cmd) for cmd in cmds)
+        return process, [util.get_flac_version(),
+                         util.get_sox_version(),
+                         util.get_lame_version()]
+
+def available():
+    """Check if the soundfile backend can be used."""
+    if sys.byteorder != "little":
+        # The samples are written to the WAV stream as they are in memory.
+        return False
+    try:
+        import soundfile
+    except (ImportError, OSError):
+        # OSError: libsndfile itself is missing
+        return False
+    return True
+
+def wav_header(channels, rate, frames):
+    """
+    The header of a 16 bit PCM WAV stream, as written by `flac -d`.
+    """
+    block_align = channels * 2
+    data_size = frames * block_align
+    return b"".join((
+        b"RIFF",
+        struct.pack("<I", 36 + data_size),
+        b"WAVEfmt ",
+        struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * block_align, block_align, 16),
+        b"data",
+        struct.pack("<I", data_size),
+    ))
+
+class FlacSource:
+    """
+    Pipeline source decoding a 16 bit FLAC file to a WAV stream.
+    (see `pipeline.Pipeline`)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.cmd = ["soundfile", str(path)]
+
+    def write(self, f):
+        import soundfile
+
+        try:
+            with soundfile.SoundFile(str(self.path)) as sf:
+                if sf.subtype != "PCM_16":
+                    raise BackendError("Only 16 bit FLAC files can be decoded, not {}".format(sf.subtype))
+                f.write(wav_header(sf.channels, sf.samplerate, sf.frames))
+                buf = bytearray(BLOCK_FRAMES * sf.channels * 2)
+                view = memoryview(buf)
+                total = 0
+                while True:
+                    n = sf.buffer_read_into(buf, "int16")
+                    if n == 0:
+                        break
+                    f.write(view[:n * sf.channels * 2])
+                    total += n
+                if total != sf.frames:
+                    raise BackendError("Decoded {} of {} samples".format(total, sf.frames))
+        except RuntimeError as e:
+            # soundfile.LibsndfileError
+            raise BackendError("Couldn't decode {}: {}".format(self.path, e))
+
+class SoundfileBackend(CliBackend):
+    """
+    Decodes with libsndfile inside this process.
+
+    Resampling is left to `sox` as libsndfile can't do it.
+    """
+    NAME = "soundfile"
+
+    def pipeline(self, src, dst, target_format, resample=None):
+        if resample is not None:
+            return super().pipeline(src, dst, target_format, resample)
+        return Pipeline([target_format.encode_cmd(dst)],
+                        inputs=[src],
+                        source=FlacSource(src))
+
+    def describe(self, src, dst, target_format, resample=None):
+        if resample is not None:
+            return super().describe(src, dst, target_format, resample)
+        import soundfile
+
+        process = "libsndfile: decode {} to 16 bit WAV | {}".format(
+                src, " ".join(target_format.encode_cmd(dst)))
+        return process, ["libsndfile {} (python-soundfile {})".format(
+                            soundfile.__libsndfile_version__,
+                            soundfile.__version__),
+                         util.get_lame_version()]
+
+BACKENDS = {
+    CliBackend.NAME: CliBackend,
+    SoundfileBackend.NAME: SoundfileBackend,
+}
+
+def get_backend(name):
+    """
+    Create the backend called `name`.
+
+    :raises BackendError: If the backend is unknown or can't be used.
+    """
+    if name not in BACKENDS:
+        raise BackendError("Unknown backend: {}".format(name))
+    if name == SoundfileBackend.NAME and not available():
+        raise BackendError("The soundfile backend requires the soundfile package and libsndfile.")
+    return BACKENDS[name]()
@@ -0,0 +1,468 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Offline benchmarks for apollo-cli.
+
+Generates a corpus of synthetic releases with sox, serves them with a
+`mocktracker.MockTracker` and times the expensive parts of apollo-cli.
+Results are appended as json lines to a file together with the current git
+commit so they can be compared across commits with `--compare`.
+"""
+
+from apolloapi import ApolloApi, CircuitBreaker, parse_better, decode_json, unescape
+from apollobetter import ApolloBetter
+from mocktracker import MockTracker, ROW_TEMPLATE, escape
+from transcode import transcode
+import backends
+import formats
+import util
+
+import mutagen.flac
+
+from pathlib import Path
+import argparse
+import contextlib
+import io
+import json
+import platform
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+# Next to this script, the file is ignored by git.
+RESULTS_PATH = Path(__file__).resolve().parent / "benchmark_results.jsonl"
+
+# (name, bits, rate, signal) of the generated releases
+RELEASES = (
+    ("16-44", 16, 44100, "sine"),
+    ("24-96", 24, 96000, "noise"),
+    ("24-192", 24, 192000, "sine"),
+)
+
+TRACKS = 4
+TRACK_SECONDS = 20
+
+EXTRAS = {
+    "album.log": "Exact Audio Copy V1.0 beta 3 from 29. August 2011\n",
+    "album.cue": 'FILE "01 - Track 1.flac" WAVE\n  TRACK 01 AUDIO\n',
+    "info.txt": "Synthetic release generated by benchmark.py\n",
+}
+
+def png(width, height):
+    """Generate a grey png image."""
+    def chunk(kind, data):
+        c = kind + data
+        return struct.pack(">I", len(data)) + c + struct.pack(">I", zlib.crc32(c))
+    raw = b"".join(b"\x00" + b"\x80" * (3 * width) for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+def generate_release(base, gid, tid, name, bits, rate, signal):
+    """
+    Generate a synthetic flac release with sox.
+
+    :returns: A `dict` like the response of `ajax.php?action=torrentgroup`
+              describing the release.
+    """
+    artist = "Benchmark Artist"
+    album = "Synthetic & Album {}".format(name)
+    dirname = "{} - {} (2018) [FLAC {}]".format(artist, album, name)
+    path = base / dirname
+    path.mkdir(parents=True, exist_ok=True)
+
+    for i in range(1, TRACKS + 1):
+        f = path / "{:02d} - Track {}.flac".format(i, i)
+        if not f.exists():
+            subprocess.run(["sox", "-n", "-r", str(rate), "-b", str(bits),
+                            "-c", "2", str(f), "synth", str(TRACK_SECONDS),
+                            signal, str(220 * i), "vol", "0.5"],
+                           check=True)
+            flac = mutagen.flac.FLAC(f)
+            flac["title"] = "Track {}".format(i)
+            flac["tracknumber"] = str(i)
+            flac["artist"] = artist
+            flac["album"] = album
+            flac["date"] = "2018"
+            flac.save()
+
+    (path / "cover.png").write_bytes(png(500, 500))
+    for n, content in EXTRAS.items():
+        (path / n).write_text(content)
+
+    files = sorted(f for f in path.glob("**/*") if f.is_file())
+    file_list = "|||".join("{}{{{{{{{}}}}}}}".format(f.relative_to(path), f.stat().st_size)
+                           for f in files)
+
+    return {
+        "group": {
+            "id": gid,
+            "name": album,
+            "year": 2018,
+            "musicInfo": {"artists": [{"id": 1, "name": artist}]},
+        },
+        "torrents": [{
+            "id": tid,
+            "media": "WEB",
+            "format": "FLAC",
+            "encoding": "Lossless" if bits == 16 else "24bit Lossless",
+            "remastered": False,
+            "remasterYear": 0,
+            "remasterTitle": "",
+            "remasterRecordLabel": "",
+            "remasterCatalogueNumber": "",
+            "hasLog": False,
+            "logScore": 0,
+            "logChecksum": 0,
+            "fileList": file_list,
+            "filePath": dirname,
+            "username": "uploader",
+        }],
+    }
+
+def generate_corpus(base):
+    """Generate all `RELEASES` in `base`. Existing files are reused."""
+    return [generate_release(base, 100 + i, 1000 + i, *r)
+            for i, r in enumerate(RELEASES)]
+
+def release_name(group):
+    """Short name of a generated release. (e.g. "24-96")"""
+    return group["group"]["name"].split()[-1]
+
+def timeit(fn, repeat):
+    """
+    Call `fn` `repeat` times.
+
+    :returns: A `dict` with the minimum and median wall time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "n": repeat}
+
+def bench_startup(repeat):
+    # scripts call the cli many times, its startup time adds up
+    script = Path(__file__).resolve().parent / "apollobetter.py"
+    def run():
+        subprocess.run([sys.executable, str(script), "-h"],
+                       stdout=subprocess.DEVNULL, check=True)
+    return {"startup/help": timeit(run, repeat * 3)}
+
+def bench_parse_file_list(repeat):
+    # a file list with 5000 entries, like a big discography
+    data = "|||".join("CD{}/{:04d} - Some Track Title.flac{{{{{{{}}}}}}}".format(i // 100, i, 30000000 + i)
+                      for i in range(5000))
+    return {"parse_file_list": timeit(lambda: util.parse_file_list(data), repeat * 10)}
+
+def bench_parse_better(repeat):
+    # a better.php page with 20000 candidates
+    rows = "".join(ROW_TEMPLATE.format(artistid=i, artist="Artist {}".format(i),
+                                       groupid=i, torrentid=100000 + i,
+                                       name="Album &amp; {}".format(i),
+                                       v2="NO", v0="YES", f320="NO")
+                   for i in range(20000))
+    content = ("<html><body><table>" + rows + "</table></body></html>").encode()
+    return {"parse_better": timeit(lambda: parse_better(content), repeat)}
+
+def large_group_response():
+    """
+    Generate a big torrentgroup response with 50 torrents, long file lists
+    and descriptions.
+    """
+    torrents = []
+    for i in range(50):
+        torrents.append({
+            "id": i,
+            "media": "CD",
+            "format": "FLAC",
+            "encoding": "Lossless",
+            "remastered": True,
+            "remasterTitle": "Deluxe Edition & Bonus Tracks",
+            "description": "Ripped with EAC & checked with <CUETools>. " * 40,
+            "fileList": "|||".join("CD{}/{:03d} - Song \"Title\" & More.flac{{{{{{{}}}}}}}".format(j // 20, j, 30000000 + j)
+                                   for j in range(200)),
+            "filePath": "Artist & Friends - Album (2018) [FLAC]",
+            "username": "uploader",
+        })
+    group = {
+        "id": 1,
+        "name": "Album <Deluxe> & More",
+        "wikiBody": "<p>Some &quot;long&quot; description.</p>" * 200,
+        "tags": ["rock", "pop & roll", "indie"],
+        "musicInfo": {"artists": [{"id": i, "name": "Artist & {}".format(i)} for i in range(10)]},
+    }
+    return {"status": "success",
+            "response": escape({"group": group, "torrents": torrents})}
+
+def bench_decode_json(repeat, responses_dir=None):
+    responses = {"large_group": json.dumps(large_group_response()).encode()}
+    if responses_dir is not None:
+        for f in sorted(responses_dir.glob("*.json")):
+            responses[f.stem] = f.read_bytes()
+
+    results = {}
+    for name, data in responses.items():
+        results["decode_json/old/" + name] = timeit(lambda: unescape(json.loads(data)), repeat * 10)
+        results["decode_json/new/" + name] = timeit(lambda: decode_json(data), repeat * 10)
+    return results
+
+def bench_check_dir(groups, corpus, repeat):
+    results = {}
+    for g in groups:
+        t = g["torrents"][0]
+        fl = util.parse_file_list(t["fileList"])
+        path = corpus / t["filePath"]
+        results["check_dir/" + release_name(g)] = timeit(lambda: util.check_dir(path, fl), repeat * 10)
+    return results
+
+def bench_transcode(groups, corpus, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for g in groups:
+            t = g["torrents"][0]
+            src = corpus / t["filePath"]
+            for f in (formats.FormatV0, formats.Format320):
+                dst = Path(tmp) / "out"
+                def run():
+                    if dst.exists():
+                        shutil.rmtree(dst)
+                    transcode(src, dst, f)
+                results["transcode/{}/{}".format(release_name(g), f.NAME)] = timeit(run, repeat)
+    return results
+
+def bench_backends(groups, corpus, repeat):
+    """
+    Time the transcodes with `backends.SoundfileBackend` and check that
+    they are identical to the ones of `backends.CliBackend`.
+
+    :returns: A tuple of the results and a `list` with the paths of all
+              files which differ.
+    """
+    results = {}
+    mismatches = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for g in groups:
+            t = g["torrents"][0]
+            src = corpus / t["filePath"]
+            for f in (formats.FormatV0, formats.Format320):
+                cli = Path(tmp) / "cli"
+                dst = Path(tmp) / "soundfile"
+                transcode(src, cli, f, backend=backends.CliBackend())
+                def run():
+                    if dst.exists():
+                        shutil.rmtree(dst)
+                    transcode(src, dst, f, backend=backends.SoundfileBackend())
+                results["transcode/{}/{}/soundfile".format(release_name(g), f.NAME)] = timeit(run, repeat)
+
+                cli_files = sorted(p.relative_to(cli) for p in cli.glob("**/*") if p.is_file())
+                dst_files = sorted(p.relative_to(dst) for p in dst.glob("**/*") if p.is_file())
+                if cli_files != dst_files:
+                    mismatches.append(src)
+                for p in cli_files:
+                    if (dst / p).is_file() and (cli / p).read_bytes() != (dst / p).read_bytes():
+                        mismatches.append(src / p)
+                shutil.rmtree(cli)
+                shutil.rmtree(dst)
+    return results, mismatches
+
+def bench_create_torrent(groups, corpus, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tfile = Path(tmp) / "bench.torrent"
+        for g in groups:
+            t = g["torrents"][0]
+            src = corpus / t["filePath"]
+            results["create_torrent_file/" + release_name(g)] = timeit(
+                lambda: util.create_torrent_file(tfile, src, "http://localhost/{}/announce",
+                                                 "passkey", "APL", overwrite=True),
+                repeat)
+    return results
+
+def bench_run(groups, corpus, repeat):
+    def run():
+        snatched = [(g["torrents"][0]["id"], ("V2", "V0", "320")) for g in groups]
+        tracker_groups = json.loads(json.dumps(groups))
+        with MockTracker(tracker_groups, snatched) as tracker, \
+                tempfile.TemporaryDirectory() as tmp, \
+                contextlib.redirect_stdout(io.StringIO()):
+            out = Path(tmp) / "out"
+            torrents = Path(tmp) / "torrents"
+            out.mkdir()
+            torrents.mkdir()
+            with ApolloApi(site_url=tracker.url, rate_limit=0) as api:
+                better = ApolloBetter("user", "pass", [corpus], out, torrents,
+                                      False, api=api)
+                better.run(allowed_formats={formats.FormatV0})
+    return {"ApolloBetter.run": timeit(run, repeat)}
+
+def check_outage(groups, corpus):
+    """
+    Run apollo-cli against a mock tracker which fails for a while and check
+    that the run survives and every format is uploaded exactly once.
+
+    The torrents are cached as if by an earlier run. ajax.php fails while
+    --unique-groups checks the group of the first release, the connection
+    breaks in the middle of the answer for the second one, and the answer
+    to the first upload is lost although the upload reached the site.
+
+    :returns: A `list` with a description of every problem found.
+    """
+    problems = []
+    snatched = [(g["torrents"][0]["id"], ("V0",)) for g in groups]
+    with MockTracker(json.loads(json.dumps(groups)), snatched) as tracker, \
+            tempfile.TemporaryDirectory() as tmp, \
+            contextlib.redirect_stdout(io.StringIO()):
+        out = Path(tmp) / "out"
+        torrents = Path(tmp) / "torrents"
+        out.mkdir()
+        torrents.mkdir()
+        # a single failed request must not open the breaker
+        with ApolloApi(site_url=tracker.url, rate_limit=0, retries=1,
+                       breaker=CircuitBreaker(threshold=2, cooldown=1)) as api:
+            better = ApolloBetter("user", "pass", [corpus], out, torrents,
+                                  True, api=api)
+            for g in groups:
+                api.get_group(g["group"]["id"])
+            api.cache.groups.clear()
+
+            tracker.inject("/ajax.php", "error", 2)
+            tracker.inject("/ajax.php", "truncate")
+            tracker.inject("/upload.php", "lost")
+            try:
+                better.run(allowed_formats={formats.FormatV0})
+            except Exception as e:
+                problems.append("The run failed during the outage: {!r}".format(e))
+
+    uploads = [int(u["groupid"]) for u in tracker.uploads]
+    expected = [g["group"]["id"] for g in groups[1:]]
+    if sorted(uploads) != sorted(expected):
+        problems.append("Expected one upload to each of the groups {} during the outage but got {}.".format(expected, uploads))
+    return problems
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                check=True).stdout.decode().strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(path):
+    """Print the median times of the last run of every commit in `path`."""
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            r = json.loads(line)
+            runs[r["commit"]] = r
+    commits = list(runs)[-4:]
+    names = sorted({n for c in commits for n in runs[c]["results"]})
+    print("{:<40}".format("benchmark") + "".join("{:>14}".format((c or "unknown")[:12]) for c in commits))
+    for n in names:
+        row = "{:<40}".format(n[:40])
+        for c in commits:
+            r = runs[c]["results"].get(n)
+            row += "{:>14}".format("{:.4f}".format(r["median"]) if r else "-")
+        print(row)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run offline benchmarks.")
+    parser.add_argument("--corpus-dir", type=Path, help="Where to generate the synthetic releases. They are reused if they allready exist. (Default: a temporary directory)")
+    parser.add_argument("--results", type=Path, default=RESULTS_PATH, help="Append the results to this file. (Default: benchmark_results.jsonl next to this script)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of repetitions of every benchmark.")
+    parser.add_argument("--responses", type=Path, help="Directory with recorded ajax.php responses (*.json) to benchmark json decoding with.")
+    parser.add_argument("--compare", action="store_true", help="Only compare the stored results of the last commits.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+        return
+
+    missing = [t for t in ("sox", "flac", "lame", "mktorrent") if shutil.which(t) is None]
+
+    results = {}
+    problems = []
+    results.update(bench_startup(args.repeat))
+    results.update(bench_parse_file_list(args.repeat))
+    results.update(bench_parse_better(args.repeat))
+    results.update(bench_decode_json(args.repeat, args.responses))
+
+    if "sox" in missing:
+        print("sox not found, skipping all benchmarks that need the corpus.")
+    else:
+        with contextlib.ExitStack() as stack:
+            corpus = args.corpus_dir
+            if corpus is None:
+                corpus = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+            print("Generating corpus in {}...".format(corpus))
+            groups = generate_corpus(corpus)
+
+            results.update(bench_check_dir(groups, corpus, args.repeat))
+            if "mktorrent" not in missing:
+                results.update(bench_create_torrent(groups, corpus, args.repeat))
+            if not missing:
+                results.update(bench_transcode(groups, corpus, args.repeat))
+                if backends.available():
+                    r, mismatches = bench_backends(groups, corpus, args.repeat)
+                    results.update(r)
+                    problems.extend("{} differs between the cli and the soundfile backend.".format(p)
+                                    for p in mismatches)
+                else:
+                    print("soundfile not found, skipping the soundfile backend.")
+                results.update(bench_run(groups, corpus, args.repeat))
+                problems.extend(check_outage(groups, corpus))
+            else:
+                print("{} not found, skipping transcode benchmarks.".format(", ".join(missing)))
+
+    for name, r in sorted(results.items()):
+        print("{:<40} {:>10.4f}s (min {:.4f}s, n={})".format(name, r["median"], r["min"], r["n"]))
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps({
+            "commit": git_commit(),
+            "time": time.time(),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "results": results,
+        }) + "\n")
+
+    if problems:
+        print("Checks failed:")
+        for p in problems:
+            print("\t{}".format(p))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Leases coordinating several apollo-cli processes working on the same
+candidates, e.g. on different hosts sharing the output directory over NFS.
+
+Before a process works on a format of a torrent it claims it by creating a
+lease file with `O_EXCL` in a shared directory. While it holds the lease a
+background thread renews its modification time. A lease which wasn't renewed
+for `LEASE_TTL` seconds belongs to a crashed process and is taken over.
+When the format was uploaded the lease is turned into a done marker so no
+other process starts it again.
+
+The clocks of all hosts must be roughly in sync.
+"""
+
+from pathlib import Path
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Seconds after which a lease that wasn't renewed is considered abandoned.
+LEASE_TTL = 300
+
+# Seconds between two renewals of the held leases.
+HEARTBEAT_INTERVAL = 30
+
+class Lease:
+    """
+    A claim on a format of a torrent. (see `LeaseManager.acquire`)
+
+    `lost` is set if another process took the lease over, e.g. because the
+    renewals were delayed for longer than `LEASE_TTL`. `keep` can be set to
+    keep it past the end of the processing of the release, e.g. for an
+    upload which is retried later.
+    """
+    def __init__(self, manager, name, token):
+        self.manager = manager
+        self.name = name
+        self.token = token
+        self.lost = False
+        self.keep = False
+        self.held = True
+
+    @property
+    def path(self):
+        return self.manager.path / (self.name + ".lease")
+
+    def owned(self):
+        """Check if the lease file still belongs to this lease."""
+        try:
+            with open(str(self.path), "r") as f:
+                return json.load(f).get("token") == self.token
+        except (OSError, ValueError):
+            return False
+
+    def finish(self):
+        """Mark the format as done and give up the lease."""
+        if self.held and not self.lost and self.owned():
+            os.rename(str(self.path), str(self.manager.path / (self.name + ".done")))
+        self.manager._forget(self)
+
+    def release(self):
+        """Give up the lease unless `keep` is set."""
+        if self.keep or not self.held:
+            return
+        if not self.lost and self.owned():
+            try:
+                os.unlink(str(self.path))
+            except FileNotFoundError:
+                pass
+        self.manager._forget(self)
+
+class LeaseManager:
+    """
+    Creates and renews leases in the directory `path`.
+
+    :param path: A directory shared by all processes. It is created if it
+                 doesn't exist.
+    :param ttl: Seconds after which a lease that wasn't renewed is taken
+                over.
+    :param interval: Seconds between two renewals.
+    """
+    def __init__(self, path, ttl=LEASE_TTL, interval=HEARTBEAT_INTERVAL):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.interval = interval
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.leases = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def acquire(self, tid, format_name):
+        """
+        Claim the format `format_name` of the torrent `tid`.
+
+        :returns: A `Lease` or `None` if another process holds the lease or
+                  the format is already done.
+        """
+        name = "{}-{}".format(tid, format_name)
+        lease_path = self.path / (name + ".lease")
+        done_path = self.path / (name + ".done")
+        if done_path.exists():
+            return None
+
+        token = uuid.uuid4().hex
+        for attempt in range(2):
+            try:
+                fd = os.open(str(lease_path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if attempt == 0 and self._take_over(lease_path):
+                    continue
+                return None
+            with os.fdopen(fd, "w") as f:
+                json.dump({"token": token, "owner": self.owner,
+                           "time": time.time()}, f)
+            break
+
+        if done_path.exists():
+            # finished by another process right before we claimed it
+            os.unlink(str(lease_path))
+            return None
+
+        lease = Lease(self, name, token)
+        with self.lock:
+            self.leases.add(lease)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+                self.thread.start()
+        return lease
+
+    def _take_over(self, lease_path):
+        """
+        Remove the lease file `lease_path` if it was abandoned.
+
+        The file is first renamed to a name unique to this process so only
+        one process can take it over.
+
+        :returns: `True` if the lease is free now.
+        """
+        try:
+            if time.time() - os.stat(str(lease_path)).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            return True
+        stale = lease_path.with_name("{}.stale-{}".format(lease_path.name, uuid.uuid4().hex))
+        try:
+            os.rename(str(lease_path), str(stale))
+        except FileNotFoundError:
+            # somebody else was faster
+            return False
+        try:
+            if time.time() - os.stat(str(stale)).st_mtime < self.ttl:
+                # renewed right before the rename, give it back
+                try:
+                    os.link(str(stale), str(lease_path))
+                except FileExistsError:
+                    pass
+                return False
+        finally:
+            os.unlink(str(stale))
+        return True
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                leases = list(self.leases)
+            for lease in leases:
+                if lease.lost:
+                    continue
+                try:
+                    if lease.owned():
+                        os.utime(str(lease.path), None)
+                        continue
+                except OSError:
+                    pass
+                lease.lost = True
+
+    def _forget(self, lease):
+        lease.held = False
+        with self.lock:
+            self.leases.discard(lease)
+
+    def close(self):
+        """Stop renewing and release all leases which aren't kept."""
+        with self.lock:
+            leases = list(self.leases)
+        for lease in leases:
+            lease.release()
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+class NullLease:
+    lost = False
+    keep = False
+
+    def finish(self):
+        pass
+
+    def release(self):
+        pass
+
+class NullLeaseManager:
+    """
+    Drop-in replacement for `LeaseManager` which grants every lease.
+
+    Used when apollo-cli runs alone.
+    """
+    def acquire(self, tid, format_name):
+        return NullLease()
+
+    def close(self):
+        pass
@@ -0,0 +1,198 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import time
+
+# Upper bounds of the stage duration histogram buckets in seconds.
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+PREFIX = "apollo_"
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """
+    Collects counters, gauges and stage timings of a run.
+
+    Stage timings are kept as histograms and exported together with all
+    counters and gauges in the Prometheus text format to `prometheus_path`.
+    A json object with the stage timings of every release is appended as a
+    single line to `jsonl_path`.
+    """
+    def __init__(self, prometheus_path=None, jsonl_path=None):
+        self.prometheus_path = prometheus_path
+        self.jsonl_path = jsonl_path
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.release = None
+
+    def inc(self, name, value=1, **labels):
+        """Increment the counter `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set the gauge `name` with the given labels to `value`."""
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, stage, seconds):
+        """Record that `stage` took `seconds`."""
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        self.histograms[stage].observe(seconds)
+        if self.release is not None:
+            stages = self.release["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager which records the time spent in its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def begin_release(self, tid):
+        """Start collecting the stage timings of the release `tid`."""
+        self.release = {
+            "torrentid": tid,
+            "time": time.time(),
+            "stages": {},
+        }
+
+    def end_release(self, **fields):
+        """
+        Finish the current release, add `fields` to its record and export
+        all metrics.
+        """
+        release = self.release
+        self.release = None
+        if release is None:
+            return
+        release["duration"] = time.time() - release["time"]
+        release.update(fields)
+        self.inc("releases_total")
+
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(release) + "\n")
+        self.write_prometheus()
+
+    def write_prometheus(self):
+        """
+        Write all metrics to `prometheus_path`.
+
+        The file is replaced atomically so it can be read by the textfile
+        collector of the node exporter at any time.
+        """
+        if self.prometheus_path is None:
+            return
+
+        def fmt_labels(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+        lines = []
+        types = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in types:
+                lines.append("# TYPE {}{} counter".format(PREFIX, name))
+                types.add(name)
+            lines.append("{}{}{} {}".format(PREFIX, name, fmt_labels(labels), value))
+        for (name, labels), value in sorted(self.gauges.items()):
+            if name not in types:
+                lines.append("# TYPE {}{} gauge".format(PREFIX, name))
+                types.add(name)
+            lines.append("{}{}{} {}".format(PREFIX, name, fmt_labels(labels), value))
+
+        name = PREFIX + "stage_seconds"
+        lines.append("# TYPE {} histogram".format(name))
+        for stage, h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h.counts):
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, cumulative))
+            lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stage, h.count))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, h.sum))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, h.count))
+
+        lines.append("# TYPE {}last_update_seconds gauge".format(PREFIX))
+        lines.append("{}last_update_seconds {}".format(PREFIX, time.time()))
+
+        tmp = "{}.{}.tmp".format(self.prometheus_path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prometheus_path)
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class NullMetrics:
+    """
+    Drop-in replacement for `Metrics` which does nothing.
+
+    Used when metrics are disabled.
+    """
+    _null_context = _NullContext()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, stage, seconds):
+        pass
+
+    def stage(self, name):
+        return self._null_context
+
+    def begin_release(self, tid):
+        pass
+
+    def end_release(self, **fields):
+        pass
+
+    def write_prometheus(self):
+        pass
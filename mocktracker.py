@@ -0,0 +1,353 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+A minimal local stand-in for the Gazelle endpoints used by apollo-cli.
+
+Only meant for benchmarks and manual testing, it implements just enough of
+login.php, ajax.php (index, torrent, torrentgroup), better.php and
+upload.php to let `ApolloApi` and `ApolloBetter` work against it offline.
+Failures can be injected with `MockTracker.inject` to test the behaviour
+of the client during outages.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from email.parser import BytesParser
+from email.policy import HTTP
+import threading
+import html
+import io
+import json
+import time
+
+USERNAME = "user"
+PASSWORD = "pass"
+SESSION = "mocksession"
+
+ROW_TEMPLATE = """<tr class="torrent_row">
+<td><a href="artist.php?id={artistid}">{artist}</a> - <a href="torrents.php?id={groupid}&amp;torrentid={torrentid}">{name}</a></td>
+<td>{v2}</td>
+<td>{v0}</td>
+<td>{f320}</td>
+</tr>
+"""
+
+def escape(obj):
+    """
+    Html escape all strings of a json data structure like Gazelle does.
+    """
+    if isinstance(obj, str):
+        return html.escape(obj, quote=False)
+    elif isinstance(obj, list):
+        return [escape(x) for x in obj]
+    elif isinstance(obj, dict):
+        return {k: escape(v) for k, v in obj.items()}
+    else:
+        return obj
+
+class MockTracker:
+    """
+    A Gazelle tracker serving a fixed set of torrent groups.
+
+    :param groups: A `list` of `dict`s like the response of
+                   `ajax.php?action=torrentgroup` with the keys "group" and
+                   "torrents".
+    :param snatched: A `list` of `(torrentid, formats_needed)` tuples listed
+                     by better.php where `formats_needed` is a collection of
+                     format names ("V2", "V0", "320").
+    :param page_size: Split better.php into pages of this many rows.
+    """
+    # Kinds of failures which can be injected:
+    #   "error": answer with 503 Service Unavailable
+    #   "hang": wait `hang_time` seconds before answering
+    #   "drop": close the connection without an answer
+    #   "lost": handle the request but close the connection without an
+    #           answer, as if the answer got lost
+    #   "truncate": close the connection after half of the answer
+    FAULTS = ("error", "hang", "drop", "lost", "truncate")
+
+    def __init__(self, groups, snatched, page_size=None):
+        self.groups = {g["group"]["id"]: g for g in groups}
+        self.torrents = {t["id"]: g for g in groups for t in g["torrents"]}
+        self.snatched = snatched
+        self.page_size = page_size
+        self.uploads = []
+        self.requests = []
+        self.faults = []
+        self.hang_time = 5
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """Start serving in a background thread on a random local port."""
+        tracker = self
+
+        class Handler(RequestHandler):
+            pass
+        Handler.tracker = tracker
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def inject(self, path, kind, count=1):
+        """
+        Let the next `count` requests to `path` (e.g. "/ajax.php") fail.
+
+        :param kind: One of `FAULTS`.
+        """
+        if kind not in self.FAULTS:
+            raise ValueError("Unknown fault: {}".format(kind))
+        with self.lock:
+            self.faults.extend([(path, kind)] * count)
+
+    def take_fault(self, path):
+        """Remove and return the next fault injected for `path`."""
+        with self.lock:
+            for i, (fault_path, kind) in enumerate(self.faults):
+                if fault_path == path:
+                    del self.faults[i]
+                    return kind
+        return None
+
+    def better_html(self, page=1):
+        snatched = self.snatched
+        pager = ""
+        if self.page_size is not None:
+            start = (page - 1) * self.page_size
+            snatched = snatched[start:start + self.page_size]
+            if start + self.page_size < len(self.snatched):
+                pager = ('<div class="linkbox"><a href="better.php?method=snatch&amp;page={}" '
+                         'class="pager_next">Next &gt;</a></div>').format(page + 1)
+
+        rows = []
+        for tid, needed in snatched:
+            g = self.torrents[tid]["group"]
+            artists = g["musicInfo"]["artists"]
+            rows.append(ROW_TEMPLATE.format(
+                artistid=artists[0]["id"] if artists else 0,
+                artist=html.escape(artists[0]["name"] if artists else ""),
+                groupid=g["id"],
+                torrentid=tid,
+                name=html.escape(g["name"]),
+                v2="NO" if "V2" in needed else "YES",
+                v0="NO" if "V0" in needed else "YES",
+                f320="NO" if "320" in needed else "YES"))
+        return ("<html><body><table>\n"
+                + "".join(rows)
+                + "</table>" + pager + "</body></html>")
+
+    def add_upload(self, fields):
+        """Add an uploaded torrent to its group."""
+        with self.lock:
+            g = self.groups[int(fields["groupid"])]
+            tid = max(self.torrents) + 1
+            t = {
+                "id": tid,
+                "media": fields.get("media", ""),
+                "format": fields.get("format", ""),
+                "encoding": fields.get("bitrate", ""),
+                "remastered": fields.get("remaster") == "on",
+                "remasterYear": int(fields.get("remaster_year") or 0),
+                "remasterTitle": fields.get("remaster_title", ""),
+                "remasterRecordLabel": fields.get("remaster_record_label", ""),
+                "remasterCatalogueNumber": fields.get("remaster_catalogue_number", ""),
+                "hasLog": False,
+                "logScore": 0,
+                "logChecksum": 0,
+                "fileList": "",
+                "filePath": "",
+                "username": USERNAME,
+            }
+            g["torrents"].append(t)
+            self.torrents[tid] = g
+            self.uploads.append(fields)
+            return tid
+
+class RequestHandler(BaseHTTPRequestHandler):
+    tracker = None
+    truncate = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, e.g. after a timeout
+            pass
+
+    def send(self, status, body=b"", content_type="text/html", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        if self.truncate:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def send_json(self, obj):
+        self.send(200, json.dumps(obj).encode(), "application/json")
+
+    def redirect(self, location, headers=()):
+        self.send(302, headers=[("Location", location), *headers])
+
+    def authenticated(self):
+        return "session=" + SESSION in self.headers.get("Cookie", "")
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def fault(self, path):
+        """
+        Apply the next fault injected for `path`.
+
+        :returns: `True` if the request must not be answered, `"lost"` if it
+                  must be handled without sending the answer.
+        """
+        kind = self.tracker.take_fault(path)
+        if kind == "error":
+            self.send(503, b"Service Unavailable")
+            return True
+        elif kind == "hang":
+            time.sleep(self.tracker.hang_time)
+        elif kind == "drop":
+            self.close_connection = True
+            return True
+        elif kind == "lost":
+            # answer into a buffer which is thrown away
+            self.wfile = io.BytesIO()
+            self.close_connection = True
+        elif kind == "truncate":
+            self.truncate = True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.tracker.requests.append(("GET", url.path, query))
+        if self.fault(url.path):
+            return
+        if url.path == "/login.php":
+            self.send(200, b"<html><body><form>Login</form></body></html>")
+        elif not self.authenticated():
+            self.redirect("login.php")
+        elif url.path == "/ajax.php":
+            self.ajax(query)
+        elif url.path == "/better.php":
+            page = int(query.get("page", 1))
+            self.send(200, self.tracker.better_html(page).encode())
+        else:
+            self.send(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_body()
+        self.tracker.requests.append(("POST", url.path, None))
+        if self.fault(url.path):
+            return
+        if url.path == "/login.php":
+            fields = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            if (fields.get("username") == USERNAME
+                    and fields.get("password") == PASSWORD):
+                self.redirect("index.php", [("Set-Cookie", "session=" + SESSION)])
+            else:
+                self.redirect("login.php")
+        elif not self.authenticated():
+            self.redirect("login.php")
+        elif url.path == "/upload.php":
+            tid = self.tracker.add_upload(self.parse_form(body))
+            self.redirect("torrents.php?torrentid={}".format(tid))
+        else:
+            self.send(404)
+
+    def parse_form(self, body):
+        header = "Content-Type: {}\r\n\r\n".format(self.headers["Content-Type"])
+        msg = BytesParser(policy=HTTP).parsebytes(header.encode() + body)
+        fields = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                fields[name] = part.get_payload(decode=True).decode()
+        return fields
+
+    def ajax(self, query):
+        action = query.get("action")
+        if action == "index":
+            response = {"username": USERNAME, "id": 1,
+                        "authkey": "authkey", "passkey": "passkey"}
+        elif action == "torrent" and int(query.get("id", 0)) in self.tracker.torrents:
+            tid = int(query["id"])
+            g = self.tracker.torrents[tid]
+            t = next(t for t in g["torrents"] if t["id"] == tid)
+            response = {"group": g["group"], "torrent": t}
+        elif action == "torrentgroup" and int(query.get("id", 0)) in self.tracker.groups:
+            response = self.tracker.groups[int(query["id"])]
+        else:
+            self.send_json({"status": "failure", "error": "bad parameters"})
+            return
+        self.send_json({"status": "success", "response": escape(response)})
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a json file of torrent groups as a mock Gazelle tracker.")
+    parser.add_argument("groups", help="A json file with a list of torrentgroup responses")
+    args = parser.parse_args()
+
+    with open(args.groups) as f:
+        groups = json.load(f)
+    snatched = [(t["id"], ("V2", "V0", "320"))
+                for g in groups for t in g["torrents"] if t["format"] == "FLAC"]
+    tracker = MockTracker(groups, snatched)
+    tracker.start()
+    print("Serving on {}".format(tracker.url))
+    try:
+        tracker.thread.join()
+    except KeyboardInterrupt:
+        tracker.stop()
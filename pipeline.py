@@ -20,17 +20,49 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import collections
 import subprocess
+import selectors
 import os
 import signal
+import threading
 import time
 
+# Number of bytes of stderr output that are kept for every process.
+STDERR_LIMIT = 16 * 1024
+
+# Size of the reads used to prefetch input files.
+PREFETCH_BUFSIZE = 1024 * 1024
+
+class ProcessUsage():
+    """
+    Resource usage of a single process as reported by `os.wait4`.
+
+    `utime` and `stime` are the user and system CPU time in seconds and `wall`
+    is the wall clock time between starting and reaping the process in
+    seconds.
+
+    The maximum resident set size isn't recorded: `ru_maxrss` of a child
+    starts at the RSS of apollo-cli it was forked from, and `VmHWM` is gone
+    once the process exited.
+    """
+    def __init__(self, utime=0.0, stime=0.0, wall=0.0):
+        self.utime = utime
+        self.stime = stime
+        self.wall = wall
+
+    @property
+    def cpu(self):
+        return self.utime + self.stime
+
 class PipelineResult():
     def __init__(self):
         self.returncodes = []
         self.stdouts = []
         self.stderrs = []
         self.cmds = []
+        self.usages = []
 
 class PipelineError(Exception):
     pass
@@ -43,7 +75,12 @@ class ProcessFailedError(PipelineError):
         self.stderr = stderr
 
     def __str__(self):
-        return "Process '{}' failed with returncode {}".format(" ".join(map(str,self.cmd)), self.returncode)
+        msg = "Process '{}' failed with returncode {}".format(" ".join(map(str,self.cmd)), self.returncode)
+        if self.stderr:
+            lines = self.stderr.decode(errors="replace").strip().splitlines()
+            if lines:
+                msg += " ({})".format(lines[-1])
+        return msg
 
 class Pipeline:
     """
@@ -52,7 +89,9 @@ class Pipeline:
 
     This is similar to the pipe operator of Unix shells.
 
-    The first process is not supplied with any input on stdin.
+    The first process is not supplied with any input on stdin unless a
+    `source` is given which is then run in a thread of this process and
+    writes to the stdin of the first process.
 
     The last process must return last as would be typical for any pipelined
     job.
@@ -60,32 +99,166 @@ class Pipeline:
     The pipeline runs in paralell to the python process in seperate processes.
     This means that you can do other stuff while it runs or even run multiple
     pipelines in paralell without the need for seperate threads.
+
+    The stderr of every process is drained whenever `check` or `drain` is
+    called and only the last `STDERR_LIMIT` bytes are kept. The stdout of the
+    last process is discarded.
+
+    Processes are reaped with `os.wait4` to collect their resource usage.
     """
-    def __init__(self, cmds):
+    def __init__(self, cmds, inputs=(), source=None, work=1):
         """
         Constructor
 
         :param cmds: A `list` of commands where each command is a `list` of
                      program arguments.
+        :param inputs: Paths of the files read by the commands. They can be
+                       prefetched by `run_pipelines`.
+        :param source: An object with an attribute `cmd`, a `list` describing
+                       it in results and error messages, and a method
+                       `write(f)` writing the input of the first command to
+                       the binary file object `f`. Any exception raised by
+                       `write` fails the pipeline.
+        :param work: The amount of work done by the pipeline, e.g. the
+                     duration of the transcoded audio in seconds. Used by
+                     limiters of `run_pipelines` to measure throughput.
         """
         self.cmds = cmds
+        self.inputs = list(inputs)
+        self.source = source
+        self.work = work
+        self.source_thread = None
+        self.source_returncode = None
+        self.source_error = b""
+        self.source_usage = None
         self.processes = None
+        self.stderrs = None
+        self.selector = None
+        self.usages = None
+        self.start_times = None
+        self.result = None
 
-    def start(self):
+    def start(self, selector=None):
         """
         Start this pipeline.
 
         Non-Blocking.
+
+        :param selector: A `selectors.BaseSelector`. If given the stderr
+                         pipes of all processes are registered with it so
+                         the caller can wait for output and call `drain`.
         """
         last_stdout = None
         self.processes = []
-        for cmd in self.cmds:
+        self.stderrs = []
+        self.usages = []
+        self.start_times = []
+        self.selector = selector
+        if self.source is not None:
+            last_stdout = subprocess.PIPE
+        for i, cmd in enumerate(self.cmds):
+            if i == len(self.cmds) - 1:
+                stdout = subprocess.DEVNULL
+            else:
+                stdout = subprocess.PIPE
             # TODO: handle exceptions raised by Popen
-            p = subprocess.Popen(cmd, stdin=last_stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p = subprocess.Popen(cmd, stdin=last_stdout, stdout=stdout, stderr=subprocess.PIPE)
+            if last_stdout is subprocess.PIPE:
+                last_stdout = None
             if last_stdout is not None:
                 last_stdout.close()
             last_stdout = p.stdout
+            os.set_blocking(p.stderr.fileno(), False)
+            if selector is not None:
+                selector.register(p.stderr, selectors.EVENT_READ, self)
             self.processes.append(p)
+            self.stderrs.append(bytearray())
+            self.usages.append(None)
+            self.start_times.append(time.monotonic())
+
+        if self.source is not None:
+            self.source_thread = threading.Thread(
+                    target=self._run_source,
+                    args=(self.processes[0].stdin,),
+                    daemon=True)
+            self.source_thread.start()
+
+    def _run_source(self, stdin):
+        """
+        Body of the source thread. Records the result of the source like
+        the returncode and usage of a process.
+        """
+        start = time.monotonic()
+        start_cpu = time.thread_time()
+        try:
+            self.source.write(stdin)
+            self.source_returncode = 0
+        except BrokenPipeError:
+            # The reader exited early, like a process killed by SIGPIPE.
+            self.source_returncode = -signal.SIGPIPE
+        except Exception as e:
+            self.source_returncode = 1
+            self.source_error = str(e).encode()
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+            self.source_usage = ProcessUsage(
+                    utime=time.thread_time() - start_cpu,
+                    wall=time.monotonic() - start)
+
+    def drain(self):
+        """
+        Read all currently available stderr output of all processes.
+
+        Only the last `STDERR_LIMIT` bytes of every process are kept.
+        Non-Blocking.
+        """
+        if self.processes is None:
+            return
+
+        for p, buf in zip(self.processes, self.stderrs):
+            while not p.stderr.closed:
+                try:
+                    data = os.read(p.stderr.fileno(), 65536)
+                except BlockingIOError:
+                    break
+                if not data:
+                    self._close_stderr(p)
+                    break
+                buf += data
+                if len(buf) > STDERR_LIMIT:
+                    del buf[:len(buf) - STDERR_LIMIT]
+
+    def _poll(self, i):
+        """
+        Like `Popen.poll` for the i-th process but reaps it with `os.wait4`
+        and records its resource usage.
+        """
+        p = self.processes[i]
+        if p.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+            except ChildProcessError:
+                # Allready reaped by Popen. (e.g. in `abort`)
+                return p.poll()
+            if pid == 0:
+                return None
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+            self.usages[i] = ProcessUsage(
+                    rusage.ru_utime,
+                    rusage.ru_stime,
+                    time.monotonic() - self.start_times[i])
+        return p.returncode
+
+    def _close_stderr(self, p):
+        if self.selector is not None:
+            self.selector.unregister(p.stderr)
+        p.stderr.close()
 
     def abort(self):
         """
@@ -109,85 +282,233 @@ class Pipeline:
                     # process is still running.
                     p.wait(timeout=5)
 
+        for p in self.processes:
+            if not p.stderr.closed:
+                self._close_stderr(p)
+
+        # The reader of the source is gone, so its writes fail now.
+        if self.source_thread is not None:
+            self.source_thread.join()
+
     def check(self):
         """
         Check if the pipeline has finished.
 
         :returns: Ether `None` if the pipeline is still running or a
                   `PipelineResult` instance if it allready finished.
+                  `PipelineResult.stderrs` contains only the last
+                  `STDERR_LIMIT` bytes of every process.
 
         :raises PipelineError: If the last process of the pipeline returned
                                but an earlier process is still running.
         """
-        if self.processes[-1].poll() is None:
+        self.drain()
+        if self._poll(len(self.processes) - 1) is None:
             return None
 
         result = PipelineResult()
-        for p in self.processes:
-            if p.poll() is None:
+        if self.source_thread is not None:
+            # The first process has exited or is about to, after which
+            # writing to its stdin fails, so this doesn't block for long.
+            self.source_thread.join()
+            result.returncodes.append(self.source_returncode)
+            result.stdouts.append(None)
+            result.stderrs.append(self.source_error)
+            result.cmds.append(self.source.cmd)
+            result.usages.append(self.source_usage)
+        for i, (p, stderr) in enumerate(zip(self.processes, self.stderrs)):
+            # An earlier process might still be exiting after closing
+            # its stdout, give it a moment.
+            deadline = time.time() + 1
+            while self._poll(i) is None and time.time() < deadline:
+                self.drain()
+                time.sleep(0.01)
+            if self._poll(i) is None:
                 raise PipelineError("The last process of a pipeline has exited but an earlier process is still running. ({})".format(p.args))
-            stderr = None
             stdout = None
-            if not p.stdout.closed:
+            if p.stdout is not None and not p.stdout.closed:
                 stdout = p.stdout.read()
                 p.stdout.close()
+            # The process has exited so everything left in the pipe can be
+            # read without blocking.
+            self.drain()
             if not p.stderr.closed:
-                stderr = p.stderr.read()
-                p.stderr.close()
+                self._close_stderr(p)
             result.returncodes.append(p.returncode)
             result.stdouts.append(stdout)
-            result.stderrs.append(stderr)
+            result.stderrs.append(bytes(stderr))
             result.cmds.append(p.args)
+            result.usages.append(self.usages[i] or ProcessUsage())
 
+        self.result = result
         return result
 
-def run_pipelines(pipelines, njobs=None):
+def read_file(path):
+    """
+    Read a file sequentially to bring it into the page cache.
+
+    Errors are ignored, the process using the file will report them.
+    """
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        buf = bytearray(PREFETCH_BUFSIZE)
+        with open(fd, "rb", buffering=0, closefd=False) as f:
+            while f.readinto(buf):
+                pass
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Prefetcher:
+    """
+    Reads the input files of pipelines into the page cache before they are
+    started, with its own limit of concurrent readers.
+
+    On slow storage (e.g. spinning disks) this replaces many processes
+    reading at once by a few sequential readers.
+
+    :param njobs: Number of files read at the same time.
+    """
+    def __init__(self, njobs):
+        self.executor = ThreadPoolExecutor(max_workers=njobs)
+        self.futures = {}
+
+    def prefetch(self, pipeline):
+        """Schedule reading the inputs of `pipeline` if not done yet."""
+        for path in pipeline.inputs:
+            if path not in self.futures:
+                self.futures[path] = self.executor.submit(read_file, path)
+
+    def ready(self, pipeline):
+        """Check if all inputs of `pipeline` have been read."""
+        self.prefetch(pipeline)
+        return all(self.futures[path].done() for path in pipeline.inputs)
+
+    def wait(self, pipeline, timeout=None):
+        """Wait till all inputs of `pipeline` have been read."""
+        self.prefetch(pipeline)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for path in pipeline.inputs:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                self.futures[path].result(remaining)
+            except FutureTimeoutError:
+                return False
+        return True
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+def run_pipelines(pipelines, njobs=None, io_jobs=None, limiter=None, check=True):
     """
     Run multiple pipelines in paralell.
 
     This function will block till all pipelines have been processes.
 
+    Pipelines are started in their order in `pipelines`. If `io_jobs` is
+    given the inputs of the next pipelines are prefetched by `io_jobs`
+    readers and a pipeline is only started once its inputs have been read,
+    so the processes always start on data which is already in the page
+    cache.
+
     :param pipelines: A sequence of `Pipeline` instances.
     :param njobs: Number of pipelines to run in paralell or `None` to
                   run 1 pipeline per available CPU core.
+    :param io_jobs: Number of input files read in paralell or `None` to
+                    disable prefetching.
+    :param limiter: An object with a method `limit(nrunning, nprocesses)`
+                    returning the number of pipelines which may run right
+                    now given the number of running pipelines and their
+                    processes, e.g. a `scheduling.LoadLimiter`. It is asked
+                    before starting a pipeline and can lower `njobs`
+                    temporarily. If it also has a method
+                    `finished(pipeline)` it is called for every finished
+                    pipeline.
+    :param check: If `False` failed pipelines don't raise an exception, the
+                  caller has to check the returncodes of the results.
+
+    :returns: A `list` with a `PipelineResult` for every pipeline in the
+              same order as `pipelines`.
 
     :raises PipelineError: If anything went wrong. (e.g. typically a command
-                           returned a returncode != 0)
+                           returned a returncode != 0 and `check` is set)
+    :raises ValueError: If `njobs` or `io_jobs` is smaller than 1.
     """
     if njobs is None:
         # set jobs to the number of available cpu cores
         njobs = len(os.sched_getaffinity(0))
+    if njobs < 1 or (io_jobs is not None and io_jobs < 1):
+        raise ValueError("njobs and io_jobs must be at least 1")
 
-    pending = pipelines
+    pending = collections.deque(pipelines)
     running = []
-    njobs = min(njobs, len(pending))
-    for i in range(njobs):
-        pipeline = pending.pop()
-        pipeline.start()
-        running.append(pipeline)
+    selector = selectors.DefaultSelector()
+    prefetcher = Prefetcher(io_jobs) if io_jobs is not None else None
+
+    def start_pending():
+        limit = njobs
+        if limiter is not None:
+            nprocesses = sum(len(p.processes) for p in running)
+            limit = min(njobs, limiter.limit(len(running), nprocesses))
+        while pending and len(running) < limit:
+            if prefetcher is not None:
+                # read ahead the inputs of as many pipelines as can run
+                for pipeline in list(pending)[:limit]:
+                    prefetcher.prefetch(pipeline)
+                if not prefetcher.ready(pending[0]):
+                    break
+            pipeline = pending.popleft()
+            pipeline.start(selector)
+            running.append(pipeline)
 
     try:
-        while running:
+        start_pending()
+        while running or pending:
             running_new = []
             for pipeline in running:
                 r = pipeline.check()
                 if r is not None:
-                    if r.returncodes[-1] != 0:
+                    if check and any(rc != 0 for rc in r.returncodes):
                         for rc, cmds, stdout, stderr in zip(r.returncodes,
                                                             r.cmds,
                                                             r.stdouts,
                                                             r.stderrs):
                             if rc != 0:
-                                raise ProcessFailedError(cmds, rc, stdout, stderr) 
-                    elif pending:
-                        new_pipeline = pending.pop()
-                        new_pipeline.start()
-                        running_new.append(new_pipeline)
+                                raise ProcessFailedError(cmds, rc, stdout, stderr)
+                    if hasattr(limiter, "finished"):
+                        limiter.finished(pipeline)
                 else:
                     running_new.append(pipeline)
-            running = running_new
-            time.sleep(0.1)
+            running[:] = running_new
+            start_pending()
+            if running:
+                # Sleep till one of the processes writes to stderr
+                # but at most 0.1s.
+                for key, _ in selector.select(timeout=0.1):
+                    key.data.drain()
+            elif pending:
+                # nothing is running, wait for the prefetcher or till the
+                # limiter allows to start a pipeline
+                if prefetcher is not None:
+                    prefetcher.wait(pending[0], timeout=0.1)
+                else:
+                    time.sleep(0.1)
     except:
         for pipeline in running:
             pipeline.abort()
         raise
+    finally:
+        selector.close()
+        if prefetcher is not None:
+            prefetcher.close()
+
+    return [pipeline.result for pipeline in pipelines]
@@ -0,0 +1,439 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Estimate the cost of transcoding candidates and order them by throughput.
+
+The cost of a release is estimated from the STREAMINFO blocks of its FLAC
+files only, nothing is decoded. The default cost model can be replaced by
+one calibrated from a usage file (see `usage.UsageReport.save`) or a short
+benchmark on this machine.
+"""
+
+import formats
+
+from collections import namedtuple
+from pathlib import Path
+import json
+import math
+import os
+import struct
+import subprocess
+import tempfile
+import wave
+
+# Estimated CPU seconds per second of audio needed by the encoder of a format.
+ENCODE_COST = {
+    formats.FormatV0.NAME: 0.020,
+    formats.FormatV2.NAME: 0.018,
+    formats.Format320.NAME: 0.025,
+    formats.FormatFlac.NAME: 0.020,
+}
+
+# Estimated CPU seconds per second of 44.1kHz audio needed to decode the
+# source with flac. Scales linearly with the sample rate.
+DECODE_COST = 0.003
+
+# Estimated CPU seconds per second of 44.1kHz audio needed to decode,
+# resample and dither the source with sox. Scales linearly with the sample
+# rate.
+RESAMPLE_COST = 0.012
+
+# Estimated average bitrate of every format in bits per second.
+BITRATE = {
+    formats.FormatV0.NAME: 245000,
+    formats.FormatV2.NAME: 190000,
+    formats.Format320.NAME: 320000,
+    formats.FormatFlac.NAME: 850000,
+}
+
+# Length in seconds of the generated audio transcoded by `calibrate`.
+CALIBRATION_SECONDS = 10
+
+class PlannerError(Exception):
+    pass
+
+ReleaseInfo = namedtuple("ReleaseInfo", ["tracks", "duration", "samples", "rate", "bits", "resample"])
+ReleaseInfo.__doc__ = """
+Properties of the audio of a release.
+
+`duration` is the total length in seconds, `samples` the total number of
+samples (per channel) and `resample` is `True` if the transcode has to
+resample the audio. (see `transcode.compute_resample`)
+"""
+
+Job = namedtuple("Job", ["candidate", "formats", "info", "cpu"])
+Job.__doc__ = """
+A candidate together with the formats to generate and its estimated cost.
+
+`info` is the `ReleaseInfo` of the source and `cpu` the estimated CPU
+time in seconds of all formats. Both are `None` if the cost is unknown.
+"""
+
+def read_streaminfo(path):
+    """
+    Read the STREAMINFO block of a FLAC file.
+
+    :returns: A tuple `(sample_rate, bits_per_sample, channels, total_samples)`.
+    :raises PlannerError: If `path` isn't a FLAC file starting with a
+                          STREAMINFO block.
+    """
+    with open(path, "rb") as f:
+        data = f.read(42)
+    # "fLaC", 4 byte metadata block header, 34 byte STREAMINFO
+    if len(data) < 42 or data[:4] != b"fLaC" or data[4] & 0x7f != 0:
+        raise PlannerError("{} has no STREAMINFO block.".format(path))
+    # sample rate (20 bits), channels - 1 (3 bits), bits per sample - 1
+    # (5 bits) and total samples (36 bits) follow the block and frame sizes
+    packed, = struct.unpack(">Q", data[18:26])
+    rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits = ((packed >> 36) & 0x1f) + 1
+    samples = packed & 0xfffffffff
+    return rate, bits, channels, samples
+
+def probe_release(path):
+    """
+    Collect the `ReleaseInfo` of all FLAC files in a directory.
+
+    :param path: `Path` to the directory of the release.
+
+    :returns: The `ReleaseInfo` or `None` if it contains no FLAC files or
+              one of them can't be read.
+    """
+    tracks = 0
+    duration = 0.0
+    samples = 0
+    rate = bits = None
+    try:
+        for f in path.glob("**/*" + formats.FormatFlac.SUFFIX):
+            r, b, _, s = read_streaminfo(f)
+            tracks += 1
+            samples += s
+            if r:
+                duration += s / r
+            rate = r if rate is None else max(rate, r)
+            bits = b if bits is None else max(bits, b)
+    except (OSError, PlannerError):
+        return None
+    if tracks == 0:
+        return None
+
+    # same rule as transcode.compute_resample
+    resample = bits > 16 or rate not in (44100, 48000)
+    return ReleaseInfo(tracks, duration, samples, rate, bits, resample)
+
+class CostModel:
+    """
+    Estimates the CPU time of transcodes.
+
+    :param encode: A `dict` mapping format names to the CPU seconds per
+                   second of audio used by their encoder.
+    :param decode: CPU seconds per second of 44.1kHz audio to decode the
+                   source with flac.
+    :param resample: CPU seconds per second of 44.1kHz audio to decode and
+                     resample the source with sox.
+    :param bitrate: A `dict` mapping format names to their average bitrate
+                    in bits per second.
+    """
+    def __init__(self, encode=None, decode=DECODE_COST, resample=RESAMPLE_COST,
+                 bitrate=None):
+        self.encode = dict(ENCODE_COST)
+        if encode is not None:
+            self.encode.update(encode)
+        self.decode = decode
+        self.resample = resample
+        self.bitrate = dict(BITRATE)
+        if bitrate is not None:
+            self.bitrate.update(bitrate)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a model saved with `save`.
+
+        :raises PlannerError: If the file can't be read.
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            return cls(data["encode"], data["decode"], data["resample"],
+                       data["bitrate"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise PlannerError("Couldn't load the cost model from {}: {}".format(path, e))
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"encode": self.encode, "decode": self.decode,
+                       "resample": self.resample, "bitrate": self.bitrate},
+                      f, indent=1)
+
+    @classmethod
+    def from_usage(cls, path):
+        """
+        Fit a model to the resource usage of earlier runs.
+
+        :param path: A usage file written by `usage.UsageReport.save`.
+
+        Values which can't be derived from the file keep their defaults.
+
+        :raises PlannerError: If the file can't be read.
+        """
+        try:
+            with open(path, "r") as f:
+                records = json.load(f)["records"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise PlannerError("Couldn't read the usage file {}: {}".format(path, e))
+
+        cpu = {}
+        audio = {}
+        def add(key, seconds, duration):
+            cpu[key] = cpu.get(key, 0.0) + seconds
+            audio[key] = audio.get(key, 0.0) + duration
+
+        sizes = {}
+        for r in records:
+            seconds = r["utime"] + r["stime"]
+            # audio seconds at 44.1kHz for the rate dependent tools
+            scaled = r["duration"] * (r.get("rate") or 44100) / 44100
+            if r["tool"] == "lame":
+                add(("encode", r["format"]), seconds, r["duration"])
+            elif r["tool"] == "sox":
+                add(("resample",), seconds, scaled)
+            elif r["tool"] == "flac" and r["format"] != formats.FormatFlac.NAME:
+                # with flac as target format decoder and encoder can't be
+                # told apart
+                add(("decode",), seconds, scaled)
+            if r.get("size") is not None:
+                sizes[(r["release"], r["format"], r["track"])] = (r["size"], r["duration"])
+
+        def rate(key):
+            return cpu[key] / audio[key] if audio.get(key) else None
+
+        model = cls()
+        for name in model.encode:
+            if rate(("encode", name)) is not None:
+                model.encode[name] = rate(("encode", name))
+        if rate(("decode",)) is not None:
+            model.decode = rate(("decode",))
+        if rate(("resample",)) is not None:
+            model.resample = rate(("resample",))
+
+        size = {}
+        duration = {}
+        for (_, name, _), (s, d) in sizes.items():
+            size[name] = size.get(name, 0) + s
+            duration[name] = duration.get(name, 0.0) + d
+        for name in size:
+            if duration[name]:
+                model.bitrate[name] = 8 * size[name] / duration[name]
+        return model
+
+    def cpu(self, info, format):
+        """Estimated CPU seconds to transcode a release to `format`."""
+        scale = info.rate / 44100
+        source = self.resample if info.resample else self.decode
+        return info.duration * (source * scale + self.encode[format.NAME])
+
+    def wall(self, info, cpu, njobs=None):
+        """
+        Estimated wall time in seconds of a transcode using `cpu` CPU seconds.
+
+        The tracks of a release are transcoded in parallel, so the wall time
+        depends on the number of tracks and cores.
+        """
+        if njobs is None:
+            njobs = os.cpu_count() or 1
+        return cpu / max(1, min(info.tracks, njobs))
+
+    def output_bytes(self, info, format):
+        """Estimated size in bytes of the transcode of a release to `format`."""
+        return info.duration * self.bitrate[format.NAME] / 8
+
+def make_job(candidate, oformats, info, model):
+    """
+    Create a `Job` estimating its cost with `model`.
+
+    :param info: The `ReleaseInfo` of the source or `None` if it is unknown.
+    """
+    if info is None:
+        return Job(candidate, oformats, None, None)
+    cpu = sum(model.cpu(info, f) for f in oformats)
+    return Job(candidate, oformats, info, cpu)
+
+def order_jobs(jobs):
+    """
+    Sort jobs by the number of uploads per CPU second, best first.
+
+    Jobs with an unknown cost are put at the end in their original order.
+    """
+    known = [j for j in jobs if j.cpu is not None]
+    unknown = [j for j in jobs if j.cpu is None]
+    known.sort(key=lambda j: len(j.formats) / max(j.cpu, 1e-6), reverse=True)
+    return known + unknown
+
+def select_jobs(jobs, model, budget_cpu=None, budget_time=None, njobs=None):
+    """
+    Select jobs in order until the estimated CPU or wall time would exceed
+    the budget. Jobs which don't fit are skipped and smaller jobs after
+    them are still selected.
+
+    Jobs with an unknown cost are only selected if there is no budget.
+
+    :param budget_cpu: Maximum CPU time in seconds or `None`.
+    :param budget_time: Maximum wall time in seconds or `None`.
+
+    :returns: A tuple `(selected, skipped)` of two `list`s of jobs.
+    """
+    selected = []
+    skipped = []
+    cpu = 0.0
+    wall = 0.0
+    for j in jobs:
+        if j.cpu is None:
+            if budget_cpu is None and budget_time is None:
+                selected.append(j)
+            else:
+                skipped.append(j)
+            continue
+        j_wall = model.wall(j.info, j.cpu, njobs)
+        if ((budget_cpu is not None and cpu + j.cpu > budget_cpu)
+                or (budget_time is not None and wall + j_wall > budget_time)):
+            skipped.append(j)
+            continue
+        cpu += j.cpu
+        wall += j_wall
+        selected.append(j)
+    return selected, skipped
+
+def write_test_signal(path, rate, bits, seconds):
+    """
+    Write a stereo wav file with a few tones and some noise.
+
+    One second of audio is generated and repeated.
+    """
+    width = bits // 8
+    scale = 2 ** (bits - 1) - 1
+    seed = 1
+    frames = bytearray()
+    for i in range(rate):
+        # cheap deterministic noise (linear congruential generator)
+        seed = (seed * 1103515245 + 12345) & 0x7fffffff
+        noise = seed / 0x7fffffff - 0.5
+        t = i / rate
+        v = (0.3 * math.sin(2 * math.pi * 440 * t)
+             + 0.2 * math.sin(2 * math.pi * 3520 * t)
+             + 0.1 * math.sin(2 * math.pi * 12000 * t)
+             + 0.05 * noise)
+        sample = int(v * scale).to_bytes(width, "little", signed=True)
+        frames += sample + sample
+
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(width)
+        w.setframerate(rate)
+        for _ in range(seconds):
+            w.writeframes(frames)
+
+def calibrate(seconds=CALIBRATION_SECONDS):
+    """
+    Measure the CPU costs of the transcode tools on this machine.
+
+    Generated audio (16 bit/44.1kHz and 24 bit/96kHz) is transcoded to all
+    lossy formats with the commands used by `transcode.transcode`. Bitrates
+    keep their defaults since generated audio doesn't compress like music.
+
+    :returns: A `CostModel`.
+    """
+    from transcode import generate_transcode_cmds
+    from pipeline import Pipeline, run_pipelines
+
+    model = CostModel()
+    lossy = sorted((f for f in formats.FORMATS if f.FORMAT == "MP3"),
+                   key=lambda f: f.NAME)
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = []
+        for rate, bits, resample in ((44100, 16, None), (96000, 24, 44100)):
+            src = Path(tmp) / "{}-{}.wav".format(bits, rate)
+            write_test_signal(src, rate, bits, seconds)
+            subprocess.run(["flac", "--silent", "-o", str(src.with_suffix(".flac")), str(src)],
+                           check=True)
+            sources.append((src.with_suffix(".flac"), rate, resample))
+
+        decode = []
+        resample_cost = []
+        for f in lossy:
+            for src, rate, resample in sources:
+                dst = Path(tmp) / ("out" + f.SUFFIX)
+                result, = run_pipelines([Pipeline(
+                    generate_transcode_cmds(src, dst, f, resample))])
+                dst.unlink()
+                source_usage, encode_usage = result.usages
+                scaled = seconds * rate / 44100
+                if resample is None:
+                    decode.append(source_usage.cpu / scaled)
+                    model.encode[f.NAME] = encode_usage.cpu / seconds
+                else:
+                    resample_cost.append(source_usage.cpu / scaled)
+
+        model.decode = sum(decode) / len(decode)
+        model.resample = sum(resample_cost) / len(resample_cost)
+    return model
+
+def plan_summary(jobs, model):
+    """
+    Generate a human readable summary of the estimated cost of `jobs`.
+    """
+    totals = {}
+    unknown = 0
+    for j in jobs:
+        if j.info is None:
+            unknown += 1
+            continue
+        for f in j.formats:
+            t = totals.setdefault(f.NAME, {"torrents": 0, "duration": 0.0,
+                                           "cpu": 0.0, "wall": 0.0, "bytes": 0.0})
+            cpu = model.cpu(j.info, f)
+            t["torrents"] += 1
+            t["duration"] += j.info.duration
+            t["cpu"] += cpu
+            t["wall"] += model.wall(j.info, cpu)
+            t["bytes"] += model.output_bytes(j.info, f)
+
+    lines = ["Plan for {} releases:".format(len(jobs) - unknown)]
+    lines.append("\t{:<8} {:>8} {:>12} {:>12} {:>12} {:>10}".format(
+        "Format", "Torrents", "Audio [h]", "CPU [h]", "Wall [h]", "Size [GiB]"))
+    for name, t in sorted(totals.items()):
+        lines.append("\t{:<8} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>10.2f}".format(
+            name, t["torrents"], t["duration"] / 3600, t["cpu"] / 3600,
+            t["wall"] / 3600, t["bytes"] / 2**30))
+    lines.append("\t{:<8} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>10.2f}".format(
+        "Total",
+        sum(t["torrents"] for t in totals.values()),
+        sum(j.info.duration for j in jobs if j.info is not None) / 3600,
+        sum(t["cpu"] for t in totals.values()) / 3600,
+        sum(t["wall"] for t in totals.values()) / 3600,
+        sum(t["bytes"] for t in totals.values()) / 2**30))
+    if unknown:
+        lines.append("The cost of {} releases is unknown.".format(unknown))
+    return "\n".join(lines)
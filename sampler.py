@@ -0,0 +1,168 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Sampling profiler for the python code of apollo-cli.
+
+A background thread periodically records the stacks of all other threads
+with `sys._current_frames`, which costs a few microseconds per sample and
+needs no instrumentation of the profiled code. Samples are attributed to
+the stage (see `metrics.Metrics.stage`) the thread was in when they were
+taken, or if it wasn't in any, to the stage of the main thread.
+
+The stacks are wall clock samples: threads waiting for I/O or processes are
+sampled as well, which shows where the time of a run goes, not only where
+CPU time is spent.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import os
+import sys
+import threading
+
+# Default time between two samples in seconds.
+SAMPLE_INTERVAL = 0.01
+
+# Name of the stage of samples taken outside of any stage.
+NO_STAGE = "other"
+
+def frame_name(code):
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+class Sampler:
+    """
+    Samples the stacks of all threads while it is running.
+
+    :param interval: Time between two samples in seconds.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        # stack of stages per thread id
+        self.stages = {}
+        self.nsamples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    @contextmanager
+    def stage(self, name):
+        """Attribute all samples taken in the body to the stage `name`."""
+        stages = self.stages.setdefault(threading.get_ident(), [])
+        stages.append(name)
+        try:
+            yield
+        finally:
+            stages.pop()
+
+    def _run(self):
+        own = threading.get_ident()
+        main = threading.main_thread().ident
+        while not self.stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stages = self.stages.get(ident) or self.stages.get(main)
+                stage = stages[-1] if stages else NO_STAGE
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-{}".format(ident)))
+                stack.append(stage)
+                self.stacks[tuple(reversed(stack))] += 1
+            self.nsamples += 1
+
+    def write_collapsed(self, path):
+        """
+        Write the samples in the collapsed stack format, one line per
+        stack with its frames separated by ";" and the number of samples.
+        The first frame is the stage, the second the thread.
+
+        The file can be turned into a flame graph by e.g. `flamegraph.pl`
+        or opened in speedscope.
+        """
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(";".join(s.replace(";", ",") for s in stack), count))
+
+    def summary(self, n=20):
+        """
+        Generate a human readable summary with the samples per stage and
+        the `n` functions with the most samples.
+
+        "Self" counts the samples in which a function was running itself,
+        "Total" those in which it was anywhere on the stack.
+        """
+        stages = Counter()
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            stages[stack[0]] += count
+            own[stack[-1]] += count
+            for name in set(stack[2:]):
+                total[name] += count
+        nstacks = sum(self.stacks.values())
+
+        def share(count):
+            return 100 * count / nstacks if nstacks else 0
+
+        lines = ["Profile ({} samples every {}ms):".format(self.nsamples, self.interval * 1000)]
+        lines.append("\t{:<24} {:>8} {:>7}".format("Stage", "Samples", "Share"))
+        for stage, count in stages.most_common():
+            lines.append("\t{:<24} {:>8} {:>6.1f}%".format(stage, count, share(count)))
+        lines.append("\t{:>8} {:>7} {:>8} {:>7}  {}".format("Self", "Share", "Total", "Share", "Function"))
+        for name, count in own.most_common(n):
+            lines.append("\t{:>8} {:>6.1f}% {:>8} {:>6.1f}%  {}".format(
+                count, share(count), total[name], share(total[name]), name))
+        return "\n".join(lines)
+
+class ProfiledMetrics:
+    """
+    Wraps a `metrics.Metrics` or `metrics.NullMetrics` so its stages are
+    also marked in a `Sampler`.
+    """
+    def __init__(self, metrics, sampler):
+        self.metrics = metrics
+        self.sampler = sampler
+
+    def __getattr__(self, name):
+        return getattr(self.metrics, name)
+
+    @contextmanager
+    def stage(self, name):
+        with self.sampler.stage(name), self.metrics.stage(name):
+            yield
@@ -0,0 +1,332 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+CPU and I/O scheduling of apollo-cli and all processes it starts.
+
+The settings are applied to the apollo-cli process itself, all transcode
+processes inherit them. (Setting them between fork and exec with a
+`preexec_fn` isn't safe while other threads are running.)
+
+Only supported on Linux.
+"""
+
+from metrics import NullMetrics
+
+import ctypes
+import os
+import platform
+import time
+
+# Number of the ioprio_set syscall on some architectures.
+IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+}
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+IOPRIO_CLASSES = {
+    "realtime": 1,
+    "best-effort": 2,
+    "idle": 3,
+}
+
+# Period of the cgroup v2 CPU quota in microseconds.
+CPU_PERIOD = 100000
+
+# CPU pressure (fraction of the time in which runnable tasks waited for a
+# CPU) above which `LoadLimiter` runs fewer and below which it runs more
+# pipelines.
+PRESSURE_HIGH = 0.2
+PRESSURE_LOW = 0.05
+
+PRESSURE_PATH = "/proc/pressure/cpu"
+
+# Relative drop of the throughput which `ConcurrencyController` takes as a
+# sign that its last step was wrong. Smaller changes are treated as noise.
+THROUGHPUT_TOLERANCE = 0.05
+
+class SchedulingError(Exception):
+    pass
+
+def parse_cpus(s):
+    """
+    Parse a list of CPUs like "0-3,6".
+
+    :returns: A `set` of CPU numbers.
+    :raises ValueError: If `s` is not a valid list.
+    """
+    cpus = set()
+    for part in s.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    if not cpus:
+        raise ValueError("empty cpu list")
+    return cpus
+
+def set_ioprio(ioclass, level=4):
+    """
+    Set the I/O scheduling class and level of this process, like `ionice`.
+
+    :param ioclass: "realtime", "best-effort" or "idle".
+    :param level: Priority within the class from 0 (highest) to 7.
+                  Ignored for "idle".
+
+    :raises SchedulingError:
+    """
+    nr = IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        raise SchedulingError("Setting the I/O priority is not supported on {}.".format(platform.machine()))
+    if ioclass == "idle":
+        level = 0
+    ioprio = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        err = ctypes.get_errno()
+        raise SchedulingError("Couldn't set the I/O priority: {}".format(os.strerror(err)))
+
+def join_cgroup(path, cpu_quota=None):
+    """
+    Move this process into a cgroup v2 and optionally limit its CPU time.
+
+    The cgroup must already exist and be writable by the user, e.g.
+    created by root or delegated by systemd.
+
+    :param path: Path of the cgroup directory. (e.g. /sys/fs/cgroup/apollo)
+    :param cpu_quota: Maximum number of CPUs the processes of the cgroup may
+                      use in total, e.g. 2.5.
+
+    :raises SchedulingError:
+    """
+    try:
+        if cpu_quota is not None:
+            with open(os.path.join(path, "cpu.max"), "w") as f:
+                f.write("{} {}\n".format(int(cpu_quota * CPU_PERIOD), CPU_PERIOD))
+        with open(os.path.join(path, "cgroup.procs"), "w") as f:
+            f.write("0\n")
+    except OSError as e:
+        raise SchedulingError("Couldn't use the cgroup {}: {}".format(path, e))
+
+def apply(nice=None, ioclass=None, iolevel=4, cpus=None, cgroup=None, cpu_quota=None):
+    """
+    Apply scheduling settings to this process and all processes it starts.
+
+    :param nice: Increment of the nice value.
+    :param ioclass: I/O scheduling class. (see `set_ioprio`)
+    :param iolevel: I/O priority within the class.
+    :param cpus: A `set` of CPUs to run on.
+    :param cgroup: Path of a cgroup v2 to join. (see `join_cgroup`)
+    :param cpu_quota: CPU limit of the cgroup.
+
+    :raises SchedulingError:
+    """
+    try:
+        if nice is not None:
+            os.nice(nice)
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        raise SchedulingError("Couldn't set the CPU priority or affinity: {}".format(e))
+    if ioclass is not None:
+        set_ioprio(ioclass, iolevel)
+    if cgroup is not None:
+        join_cgroup(cgroup, cpu_quota)
+
+def read_cpu_pressure():
+    """
+    Read the total time in which runnable tasks waited for a CPU from
+    `PRESSURE_PATH`. (Linux 4.20 or newer)
+
+    :returns: The time in seconds or `None` if it isn't available.
+    """
+    try:
+        with open(PRESSURE_PATH) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    for field in fields[1:]:
+                        key, _, value = field.partition("=")
+                        if key == "total":
+                            return int(value) / 1e6
+    except (OSError, ValueError):
+        pass
+    return None
+
+class LoadLimiter:
+    """
+    Limits the number of parallel pipelines of `pipeline.run_pipelines`
+    by the load caused by other processes.
+
+    If the kernel reports the CPU pressure (see `read_cpu_pressure`) the
+    share of time in which tasks waited for a CPU is measured over every
+    `interval`. Above `PRESSURE_HIGH` one pipeline less is allowed, below
+    `PRESSURE_LOW` one more. Our own pipelines only cause pressure if they
+    compete with each other or with other processes, so the number of
+    pipelines settles where the CPUs are busy without starving anyone.
+
+    Otherwise the load of other processes is estimated as the 1 minute load
+    average minus the number of processes of our running pipelines (e.g.
+    two for flac|lame), and as many pipelines as there are CPUs left over
+    are allowed. Because the load average lags by about a minute it reacts
+    slowly, and the workers vetting upcoming releases count as other load.
+
+    In both cases at least one and at most `njobs` pipelines are allowed.
+
+    :param njobs: Maximum number of parallel pipelines or `None` for the
+                  number of available CPU cores.
+    :param interval: Minimum time in seconds between reading the load.
+    """
+    def __init__(self, njobs=None, interval=1):
+        self.ncpus = len(os.sched_getaffinity(0))
+        self.njobs = njobs if njobs is not None else self.ncpus
+        self.interval = interval
+        self.last_check = None
+        self.last_pressure = read_cpu_pressure()
+        self.current = self.njobs
+
+    def limit(self, nrunning, nprocesses=None):
+        """
+        :param nrunning: Number of currently running pipelines.
+        :param nprocesses: Number of processes of the running pipelines or
+                           `None` to assume one per pipeline.
+
+        :returns: Number of pipelines allowed to run now.
+        """
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.interval:
+            return self.current
+
+        pressure = read_cpu_pressure()
+        if pressure is not None and self.last_pressure is not None:
+            if self.last_check is not None:
+                share = (pressure - self.last_pressure) / (now - self.last_check)
+                if share > PRESSURE_HIGH:
+                    self.current -= 1
+                elif share < PRESSURE_LOW and nrunning >= self.current:
+                    self.current += 1
+        else:
+            if nprocesses is None:
+                nprocesses = nrunning
+            other = max(0.0, os.getloadavg()[0] - nprocesses)
+            self.current = int(self.ncpus - other)
+        self.last_check = now
+        self.last_pressure = pressure
+        self.current = max(1, min(self.njobs, self.current))
+        return self.current
+
+class ConcurrencyController:
+    """
+    Adjusts the number of parallel pipelines of `pipeline.run_pipelines` to
+    the highest throughput, measured as the work of the finished pipelines
+    (seconds of audio) per second.
+
+    The throughput is measured over windows of at least `interval` seconds
+    in which pipelines were running. After every window the number of
+    pipelines is moved one step further in the same direction, or back if
+    the throughput dropped by more than `THROUGHPUT_TOLERANCE`, so it keeps
+    probing around the best value as the mix of transcodes changes.
+
+    The current number of pipelines and the measured throughput are exported
+    as the gauges "pipeline_jobs" and "pipeline_throughput", every change as
+    the counter "pipeline_jobs_changes_total" of `metrics`.
+
+    :param min_jobs: Lower bound of the number of parallel pipelines.
+    :param max_jobs: Upper bound or `None` for twice the number of available
+                     CPU cores. `run_pipelines` must allow as many.
+    :param interval: Minimum length of a window in seconds.
+    :param metrics: A `metrics.Metrics` or `None`.
+    """
+    def __init__(self, min_jobs=1, max_jobs=None, interval=10, metrics=None):
+        ncpus = len(os.sched_getaffinity(0))
+        self.min_jobs = max(1, min_jobs)
+        self.max_jobs = max(self.min_jobs, max_jobs if max_jobs is not None else 2 * ncpus)
+        self.interval = interval
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.current = self._clamp(ncpus)
+        self.direction = 1
+        self.last_throughput = None
+        self.last_call = None
+        self.busy = 0.0
+        self.work = 0.0
+        self.nfinished = 0
+        self.running = 0
+        self.metrics.set("pipeline_jobs", self.current)
+
+    def _clamp(self, n):
+        return max(self.min_jobs, min(self.max_jobs, n))
+
+    def limit(self, nrunning, nprocesses=None):
+        """
+        :param nrunning: Number of currently running pipelines.
+        :param nprocesses: Ignored.
+
+        :returns: Number of pipelines allowed to run now.
+        """
+        now = time.monotonic()
+        if self.last_call is not None and self.running > 0:
+            # time without running pipelines, e.g. between two releases,
+            # doesn't count
+            self.busy += now - self.last_call
+        self.last_call = now
+        self.running = nrunning
+
+        if self.busy >= self.interval and self.nfinished >= self.current:
+            self._adjust(self.work / self.busy)
+            self.busy = 0.0
+            self.work = 0.0
+            self.nfinished = 0
+        return self.current
+
+    def finished(self, pipeline):
+        """Account for the work of a finished pipeline."""
+        self.work += pipeline.work
+        self.nfinished += 1
+
+    def _adjust(self, throughput):
+        if (self.last_throughput is not None
+                and throughput < self.last_throughput * (1 - THROUGHPUT_TOLERANCE)):
+            # the last step made it worse
+            self.direction = -self.direction
+        new = self._clamp(self.current + self.direction)
+        if new == self.current:
+            # at a bound, probe the other way
+            self.direction = -self.direction
+            new = self._clamp(self.current + self.direction)
+
+        if new != self.current:
+            self.metrics.inc("pipeline_jobs_changes_total",
+                             direction="up" if new > self.current else "down")
+        self.metrics.set("pipeline_throughput", throughput)
+        self.metrics.set("pipeline_jobs", new)
+        self.last_throughput = throughput
+        self.current = new
@@ -0,0 +1,238 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Spectral analysis of FLAC releases to detect lossy sources and upsampling.
+
+Only a short window from the middle of every track is decoded and analyzed
+so checking a release is much cheaper than transcoding it.
+
+This module requires numpy which is an optional dependency of apollo-cli.
+"""
+
+import formats
+
+import mutagen.flac
+
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Length of the analyzed window of every track in seconds.
+WINDOW_SECONDS = 4
+
+# FFT size for 44.1/48kHz material. Scaled up for higher sample rates
+# to keep the frequency resolution roughly constant.
+FFT_SIZE = 4096
+
+# Releases with a cutoff below this frequency (in Hz) are probably
+# transcoded from a lossy source.
+LOSSY_CUTOFF = 19000
+
+# Hi-res releases (> 48kHz) with a cutoff below this frequency (in Hz)
+# are probably upsampled from 44.1 or 48kHz.
+UPSAMPLE_CUTOFF = 24500
+
+# Minimum drop in dB at the cutoff frequency compared to everything above it.
+CUTOFF_DROP = 25
+
+# Width of the transition band at the cutoff in Hz.
+CUTOFF_WIDTH = 300
+
+# Windows that are quieter than this (mean power in dBFS) are ignored.
+SILENCE_THRESHOLD = -70
+
+class SpectralError(Exception):
+    pass
+
+def available():
+    """
+    Check if spectral analysis is available. (numpy is installed)
+    """
+    return np is not None
+
+def fft_size(rate):
+    """Compute the FFT size for a sample rate."""
+    size = FFT_SIZE
+    while size * 44100 < FFT_SIZE * rate:
+        size *= 2
+    return size
+
+def decode_window(path, flac, buf):
+    """
+    Decode a window from the middle of a flac file.
+
+    :param path: `Path` to the flac file.
+    :param flac: The `mutagen.flac.FLAC` object of `path`.
+    :param buf: A `bytearray` which will receive the raw pcm data.
+                It must be large enough to hold `WINDOW_SECONDS` of audio.
+
+    :returns: A numpy array of shape (channels, samples) with values
+              normalized to [-1, 1) or `None` if the track is too short.
+
+    :raises SpectralError: If decoding failed.
+    """
+    info = flac.info
+    width = (info.bits_per_sample + 7) // 8
+    nsamples = min(info.total_samples, WINDOW_SECONDS * info.sample_rate)
+    if nsamples < fft_size(info.sample_rate):
+        return None
+    start = (info.total_samples - nsamples) // 2
+
+    nbytes = nsamples * info.channels * width
+    view = memoryview(buf)[:nbytes]
+    p = subprocess.Popen(["flac", "-dcs",
+                          "--force-raw-format",
+                          "--endian=little",
+                          "--sign=signed",
+                          "--skip={}".format(start),
+                          "--until=+{}".format(nsamples),
+                          "--", str(path)],
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL)
+    nread = 0
+    with p.stdout:
+        while nread < nbytes:
+            n = p.stdout.readinto(view[nread:])
+            if not n:
+                break
+            nread += n
+    if p.wait() != 0 or nread != nbytes:
+        raise SpectralError("Decoding {} failed.".format(path.name))
+
+    raw = np.frombuffer(buf, dtype=np.uint8, count=nbytes)
+    if width == 2:
+        samples = raw.view("<i2")
+    else:
+        # Sign extend the packed little endian samples to 32 bits.
+        padded = np.zeros((nbytes // width, 4), dtype=np.uint8)
+        padded[:, 4 - width:] = raw.reshape(-1, width)
+        samples = padded.view("<i4").ravel() >> (8 * (4 - width))
+
+    scale = float(1 << (8 * width - 1))
+    return samples.reshape(-1, info.channels).T / scale
+
+def power_spectrum(samples, size):
+    """
+    Compute the mean power spectrum of all channels of `samples`.
+
+    The samples are split into non-overlapping frames of `size` samples
+    and all frames are transformed in a single batched FFT.
+
+    :returns: A numpy array with `size // 2 + 1` power values.
+    """
+    nframes = samples.shape[1] // size
+    frames = samples[:, :nframes * size].reshape(samples.shape[0], nframes, size)
+    spectrum = np.fft.rfft(frames * np.hanning(size), axis=-1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    return power.mean(axis=(0, 1)) / size
+
+def find_cutoff(power, rate):
+    """
+    Find a lowpass cutoff in a power spectrum.
+
+    A cutoff is a steep drop of at least `CUTOFF_DROP` dB above which the
+    spectrum never recovers.
+
+    :returns: The cutoff frequency in Hz or `None` if the spectrum has no
+              cutoff.
+    """
+    bin_hz = rate / (2 * (len(power) - 1))
+    w = max(1, int(CUTOFF_WIDTH / bin_hz))
+
+    db = 10 * np.log10(power + 1e-20)
+    # smooth[k] is the mean level of the `w` bins starting at bin k
+    c = np.cumsum(np.insert(db, 0, 0))
+    smooth = (c[w:] - c[:-w]) / w
+    # peak[k] is the maximum smoothed level of all bins from k upwards
+    peak = np.maximum.accumulate(smooth[::-1])[::-1]
+
+    # drop[j - w] compares the band right below bin j with everything above
+    # the transition band [j, j + w)
+    n = len(smooth)
+    drop = smooth[:n - 2 * w] - peak[2 * w:]
+
+    first = max(0, int(8000 / bin_hz) - w)
+    candidates = np.nonzero(drop[first:] >= CUTOFF_DROP)[0]
+    if len(candidates) == 0:
+        return None
+    return (first + candidates[0] + w) * bin_hz
+
+def check_release(path):
+    """
+    Check a flac release for signs of a lossy source or upsampling.
+
+    :param path: `Path` to the directory containing the release.
+
+    :returns: A string containing a description of the problem if there was
+              one, or `None` if no problems were detected.
+
+    :raises SpectralError: If numpy is not available.
+    """
+    if not available():
+        raise SpectralError("Spectral analysis requires numpy.")
+
+    files = sorted(path.glob("**/*" + formats.FormatFlac.SUFFIX))
+    try:
+        flacs = [mutagen.flac.FLAC(f) for f in files]
+    except mutagen.MutagenError as e:
+        return str(e)
+    if not flacs:
+        return None
+
+    info = flacs[0].info
+    rate = info.sample_rate
+    size = fft_size(rate)
+    maxchannels = max(flac.info.channels for flac in flacs)
+    buf = bytearray(WINDOW_SECONDS * rate * maxchannels * 4)
+    total = np.zeros(size // 2 + 1)
+    nwindows = 0
+
+    for f, flac in zip(files, flacs):
+        if flac.info.sample_rate != rate:
+            return "Inconsistent sample rate"
+        try:
+            samples = decode_window(f, flac, buf)
+        except SpectralError as e:
+            return str(e)
+        if samples is None:
+            continue
+        power = power_spectrum(samples, size)
+        if 10 * np.log10(power.sum() / size + 1e-20) < SILENCE_THRESHOLD:
+            continue
+        total += power
+        nwindows += 1
+
+    if nwindows == 0:
+        return None
+
+    cutoff = find_cutoff(total / nwindows, rate)
+    if cutoff is None:
+        return None
+    if cutoff < LOSSY_CUTOFF:
+        return "Spectrum has a cutoff at {:.1f}kHz, probably a lossy source.".format(cutoff / 1000)
+    if rate > 48000 and cutoff < UPSAMPLE_CUTOFF:
+        return "Spectrum has a cutoff at {:.1f}kHz, probably upsampled.".format(cutoff / 1000)
+    return None
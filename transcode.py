@@ -20,12 +20,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from pipeline import Pipeline, run_pipelines, PipelineError
+from pipeline import run_pipelines, PipelineError
+import backends
 import formats
 
-import mutagen.flac
-import mutagen.mp3
-from mutagen.easyid3 import EasyID3
+# mutagen is imported in the functions which need it to keep the startup
+# of the command line interface fast.
 
 import subprocess
 import os
@@ -167,7 +167,11 @@ def copy_tags(src, dst):
 
     Both `src` and `dst` must be `mutagen.FileType` objects.
     """
+    import mutagen.mp3
+    from mutagen.easyid3 import EasyID3
+
     if type(dst) == mutagen.mp3.EasyMP3:
+        register_easyid3_keys()
         valid_tag_fn = lambda k: k in EasyID3.valid_keys.keys()
     else:
         valid_tag_fn = lambda k: True
@@ -181,7 +185,7 @@ def copy_tags(src, dst):
 class TranscodeError(Exception):
     pass
 
-def transcode(src, dst, target_format, njobs=None):
+def transcode(src, dst, target_format, njobs=None, io_jobs=None, limiter=None, backend=None):
     """
     Transcode a release.
 
@@ -194,9 +198,24 @@ def transcode(src, dst, target_format, njobs=None):
                           transcoded. See `formats.py`.
     :param njobs: Number of transcodes to run in parallel. If `None` it will
                   default to the number of available CPU cores.
+    :param io_jobs: Number of source files to prefetch in parallel or `None`
+                    to let every transcode read its source itself.
+                    (see `pipeline.run_pipelines`)
+    :param limiter: Lowers the number of parallel transcodes temporarily.
+                    (see `pipeline.run_pipelines`)
+    :param backend: The backend running the transcodes or `None` for a
+                    `backends.CliBackend`. (see `backends`)
+
+    :returns: A `list` of `(path, info, result)` tuples, one for every
+              transcoded FLAC file. `path` is the path of the FLAC file
+              relative to `src`, `info` its `mutagen.flac.StreamInfo` and
+              `result` the `pipeline.PipelineResult` of its transcode.
 
     :raises TranscodeError:
     """
+    import mutagen.flac
+    import mutagen.mp3
+
     if dst.exists():
         raise TranscodeError("Destination directory ({}) allready exists".format(dst))
     if not dst.parent.is_dir():
@@ -212,6 +231,8 @@ def transcode(src, dst, target_format, njobs=None):
         raise TranscodeError(msg)
 
     resample = compute_resample(flacs[0])
+    if backend is None:
+        backend = backends.CliBackend()
 
     try:
         dst.mkdir()
@@ -219,22 +240,22 @@ def transcode(src, dst, target_format, njobs=None):
         raise TranscodeError("You do not have permission to write to the destination directory ({})".format(dst))
 
     jobs = []
-    for f_src, f_dst in zip(files, transcoded_files):
+    for f_src, f_dst, flac in zip(files, transcoded_files, flacs):
         f_dst.parent.mkdir(parents=True, exist_ok=True)
-        cmds = generate_transcode_cmds(
-            f_src,
-            f_dst,
-            target_format,
-            resample)
-        jobs.append(Pipeline(cmds))
+        job = backend.pipeline(f_src, f_dst, target_format, resample)
+        job.work = flac.info.length
+        jobs.append(job)
 
     try:
-        run_pipelines(jobs)
+        results = run_pipelines(jobs, njobs, io_jobs, limiter)
 
         for flac, transcode in zip(flacs, transcoded_files):
             copy_tags(flac, mutagen.mp3.EasyMP3(transcode))
 
         copy_files(src, dst, ALLOWED_EXTENSIONS)
+
+        return [(f.relative_to(src), flac.info, r)
+                for f, flac, r in zip(files, flacs, results)]
     except PipelineError as e:
         shutil.rmtree(dst)
         raise TranscodeError("Transcode failed: " + str(e))
@@ -246,27 +267,44 @@ def transcode(src, dst, target_format, njobs=None):
 
 # EasyID3 extensions:
 
-for key, frameid in {
-            "albumartist": "TPE2",
-            "album artist": "TPE2",
-            "grouping": "TIT1",
-            "content group": "TIT1",
-        }.items():
-    EasyID3.RegisterTextKey(key, frameid)
-
 def comment_get(id3, _):
     return [comment.text for comment in id3["COMM"].text]
 
 def comment_set(id3, _, value):
+    import mutagen.id3
     id3.add(mutagen.id3.COMM(encoding=3, lang="eng", desc="", text=value))
 
 def originaldate_get(id3, _):
     return [stamp.text for stamp in id3["TDOR"].text]
 
 def originaldate_set(id3, _, value):
+    import mutagen.id3
     id3.add(mutagen.id3.TDOR(encoding=3, text=value))
 
-EasyID3.RegisterKey("comment", comment_get, comment_set)
-EasyID3.RegisterKey("description", comment_get, comment_set)
-EasyID3.RegisterKey("originaldate", originaldate_get, originaldate_set)
-EasyID3.RegisterKey("original release date", originaldate_get, originaldate_set)
+_easyid3_registered = False
+
+def register_easyid3_keys():
+    """
+    Register the additional EasyID3 keys used by `copy_tags`.
+
+    Done on first use instead of at import time so mutagen is only loaded
+    when it's needed.
+    """
+    global _easyid3_registered
+    if _easyid3_registered:
+        return
+    from mutagen.easyid3 import EasyID3
+
+    for key, frameid in {
+                "albumartist": "TPE2",
+                "album artist": "TPE2",
+                "grouping": "TIT1",
+                "content group": "TIT1",
+            }.items():
+        EasyID3.RegisterTextKey(key, frameid)
+
+    EasyID3.RegisterKey("comment", comment_get, comment_set)
+    EasyID3.RegisterKey("description", comment_get, comment_set)
+    EasyID3.RegisterKey("originaldate", originaldate_get, originaldate_set)
+    EasyID3.RegisterKey("original release date", originaldate_get, originaldate_set)
+    _easyid3_registered = True
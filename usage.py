@@ -0,0 +1,122 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from pathlib import Path
+import json
+
+class UsageReport:
+    """
+    Collects the resource usage of all transcoded tracks of a run.
+
+    Every record describes a single process of a transcode pipeline and
+    contains the keys "release", "format", "track", "duration" (audio length
+    of the track in seconds), "rate" (sample rate of the source), "size"
+    (size of the transcoded file in bytes), "tool" (name of the executable),
+    "utime", "stime" and "wall". See `pipeline.ProcessUsage`.
+    """
+    def __init__(self):
+        self.records = []
+
+    def add(self, release, format, track, duration, result, rate=None, size=None):
+        """
+        Add the usage of a transcoded track.
+
+        :param release: ID of the source torrent.
+        :param format: Name of the output format.
+        :param track: Name of the track. (e.g. relative path of the flac)
+        :param duration: Length of the track in seconds.
+        :param result: The `pipeline.PipelineResult` of the track.
+        :param rate: Sample rate of the source.
+        :param size: Size of the transcoded file in bytes.
+        """
+        for cmd, usage in zip(result.cmds, result.usages):
+            self.records.append({
+                "release": release,
+                "format": format,
+                "track": track,
+                "duration": duration,
+                "rate": rate,
+                "size": size,
+                "tool": Path(str(cmd[0])).name,
+                "utime": usage.utime,
+                "stime": usage.stime,
+                "wall": usage.wall,
+            })
+
+    def rollup(self, *keys):
+        """
+        Sum up the records grouped by `keys`.
+
+        :returns: A `dict` mapping a tuple of the values of `keys` to a
+                  `dict` with the summed up "utime", "stime", "cpu", "wall"
+                  and "duration" of all distinct tracks.
+        """
+        totals = {}
+        tracks = {}
+        for r in self.records:
+            k = tuple(r[key] for key in keys)
+            t = totals.setdefault(k, {"utime": 0.0, "stime": 0.0, "cpu": 0.0,
+                                      "wall": 0.0, "duration": 0.0})
+            t["utime"] += r["utime"]
+            t["stime"] += r["stime"]
+            t["cpu"] += r["utime"] + r["stime"]
+            t["wall"] += r["wall"]
+            track = (r["release"], r["format"], r["track"])
+            if track not in tracks.setdefault(k, set()):
+                tracks[k].add(track)
+                t["duration"] += r["duration"]
+        return totals
+
+    def summary(self):
+        """
+        Generate a human readable summary of the CPU usage per format and
+        per tool.
+        """
+        total = sum(r["utime"] + r["stime"] for r in self.records)
+        lines = ["Resource usage:"]
+        for title, key in (("Format", "format"), ("Tool", "tool")):
+            lines.append("\t{:<8} {:>10} {:>7} {:>12}".format(
+                title, "CPU [s]", "Share", "CPU/min [s]"))
+            for (name,), t in sorted(self.rollup(key).items()):
+                lines.append("\t{:<8} {:>10.1f} {:>6.1f}% {:>12.2f}".format(
+                    name,
+                    t["cpu"],
+                    100 * t["cpu"] / total if total else 0,
+                    60 * t["cpu"] / t["duration"] if t["duration"] else 0))
+        return "\n".join(lines)
+
+    def save(self, path):
+        """
+        Write all records and the rollups per track, format and release
+        as json to `path`.
+        """
+        def rollup(*keys):
+            return [dict(zip(keys, k), **v) for k, v in sorted(self.rollup(*keys).items())]
+
+        with open(path, "w") as f:
+            json.dump({
+                "records": self.records,
+                "tracks": rollup("release", "format", "track"),
+                "formats": rollup("format"),
+                "tools": rollup("format", "tool"),
+                "releases": rollup("release"),
+            }, f, indent=1)
@@ -21,15 +21,31 @@ SOFTWARE.
 """
 
 import transcode
+import backends
 import formats
 
 from pathlib import Path
 import subprocess
 import locale
+import errno
 import re
 import os
-import mutagen.flac
-from mutagen import MutagenError
+import shutil
+import json
+
+# Suffixes accepted by `parse_size`.
+SIZE_SUFFIXES = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+def parse_size(s):
+    """
+    Parse a size like "500M" or "20G" into bytes.
+
+    :raises ValueError: If `s` is not a valid size.
+    """
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", s, re.IGNORECASE)
+    if m is None:
+        raise ValueError("invalid size: {!r}".format(s))
+    return int(float(m.group(1)) * SIZE_SUFFIXES[m.group(2).upper()])
 
 def get_artist_name(torrent):
     g = torrent["group"]
@@ -61,6 +77,47 @@ def generate_transcode_name(torrent, output_format):
     # replace characters which aren't allowed in (windows) paths with "_"
     return re.sub(r'[\\/:"*?<>|]+', "_", name)
 
+# Fields which together with the media identify an edition of a release.
+EDITION_FIELDS = (
+    "remasterYear",
+    "remasterTitle",
+    "remasterRecordLabel",
+    "remasterCatalogueNumber",
+)
+
+def same_edition(a, b):
+    """
+    Check if the torrents `a` and `b` belong to the same edition.
+
+    :param a: The "torrent" `dict` of a torrent.
+    :param b: The "torrent" `dict` of a torrent.
+    """
+    if a["media"] != b["media"] or bool(a["remastered"]) != bool(b["remastered"]):
+        return False
+    return not a["remastered"] or all(a[k] == b[k] for k in EDITION_FIELDS)
+
+def existing_formats(group, torrent, username=None):
+    """
+    Find the formats which already exist in the edition of a torrent.
+
+    :param group: A torrent group as returned by `api.get_group`.
+    :param torrent: A `dict` as returned by `api.get_torrent`.
+    :param username: If given only torrents uploaded by this user count.
+
+    :returns: A `set` of formats. (see `formats`)
+    """
+    t = torrent["torrent"]
+    existing = set()
+    for other in group["torrents"]:
+        if other["id"] == t["id"] or not same_edition(t, other):
+            continue
+        if username is not None and other.get("username") != username:
+            continue
+        for f in formats.FORMATS:
+            if other["format"] == f.FORMAT and other["encoding"] == f.BITRATE:
+                existing.add(f)
+    return existing
+
 def create_torrent_file(torrent_path, data_path, tracker, passkey=None,
         source=None, piece_length=18, overwrite=False):
     """
@@ -129,13 +186,16 @@ def check_source_release(path, torrent):
     """
     fl = parse_file_list(torrent["torrent"]["fileList"])
     if not check_dir(path, fl):
-        return (False, "Directory doesn't match the torrents file list.")
+        return "Directory doesn't match the torrents file list."
+
+    import mutagen.flac
+    from mutagen import MutagenError
 
     files = list(path.glob("**/*" + formats.FormatFlac.SUFFIX))
     try:
         flacs = [mutagen.flac.FLAC(f) for f in files]
     except MutagenError as e:
-        return (False, str(e))
+        return str(e)
 
     return transcode.check_flacs(flacs)
 
@@ -196,64 +256,161 @@ def find_dir(name, search_dirs):
             else:
                 raise
 
+def publish_dir(src, dst):
+    """
+    Move the directory `src` to `dst` so that `dst` appears complete at once.
+
+    If both are on the same file system `src` is simply renamed. Otherwise it
+    is copied to a hidden ".partial" directory next to `dst` which is renamed
+    to `dst` when the copy is complete. Only the file contents are copied,
+    no metadata, to keep the number of operations on network file systems
+    low.
+
+    :raises FileExistsError: If `dst` already exists.
+    :raises OSError:
+    """
+    if dst.exists():
+        raise FileExistsError("{} allready exists.".format(dst))
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    partial = dst.with_name("." + dst.name + ".partial")
+    if partial.exists():
+        # left over from an aborted run
+        shutil.rmtree(partial)
+    try:
+        # not shutil.copytree, it copies the metadata of every directory
+        for root, dirs, files in os.walk(str(src)):
+            target = partial / Path(root).relative_to(src)
+            target.mkdir()
+            for name in files:
+                shutil.copyfile(os.path.join(root, name), str(target / name))
+        os.rename(partial, dst)
+    except:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    shutil.rmtree(src)
+
+# The commands used to query the version of every tool and functions
+# extracting the version from their output.
+TOOL_VERSION_CMDS = {
+    "flac": (["flac", "--version"], lambda out: out.strip()),
+    "sox": (["sox", "--version"], lambda out: out.split(":")[1].strip()),
+    "lame": (["lame", "--version"], lambda out: out.splitlines()[0].strip()),
+}
+
+def cache_dir():
+    """
+    Directory for persistent caches of apollo-cli. (Respects XDG_CACHE_HOME)
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(base) / "apollo-cli"
+
+def get_tool_versions():
+    """
+    Get the versions of all tools in `TOOL_VERSION_CMDS`.
+
+    The versions are cached on disk, keyed by the path and modification
+    time of the binaries, so the tools are only started again after they
+    were updated. Tools missing from the cache are all queried at once.
+
+    :returns: A `dict` mapping the name of a tool to its version.
+    """
+    if hasattr(get_tool_versions, "versions"):
+        return get_tool_versions.versions
+
+    cache_path = cache_dir() / "tool_versions.json"
+    try:
+        with cache_path.open("r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    versions = {}
+    keys = {}
+    for name, (cmd, _) in TOOL_VERSION_CMDS.items():
+        path = shutil.which(cmd[0])
+        if path is not None:
+            keys[name] = [path, os.stat(path).st_mtime_ns]
+            entry = cache.get(name)
+            if isinstance(entry, dict) and entry.get("key") == keys[name]:
+                versions[name] = entry["version"]
+
+    missing = [name for name in TOOL_VERSION_CMDS if name not in versions]
+    if missing:
+        processes = {name: subprocess.Popen(TOOL_VERSION_CMDS[name][0],
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL,
+                                            encoding=locale.getpreferredencoding(False))
+                     for name in missing}
+        for name, p in processes.items():
+            out, _ = p.communicate()
+            versions[name] = TOOL_VERSION_CMDS[name][1](out)
+            if name in keys:
+                cache[name] = {"key": keys[name], "version": versions[name]}
+
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_path.with_name("{}.{}.tmp".format(cache_path.name, os.getpid()))
+            with tmp.open("w") as f:
+                json.dump(cache, f)
+            os.replace(str(tmp), str(cache_path))
+        except OSError:
+            # the cache is only an optimization
+            pass
+
+    get_tool_versions.versions = versions
+    return versions
+
 def get_flac_version():
-    if not hasattr(get_flac_version, "version"):
-        cp = subprocess.run(["flac", "--version"],
-                            stdout=subprocess.PIPE,
-                            encoding=locale.getpreferredencoding(False))
-        get_flac_version.version = cp.stdout.strip()
-    return get_flac_version.version
+    return get_tool_versions()["flac"]
 
 def get_sox_version():
-    if not hasattr(get_sox_version, "version"):
-        cp = subprocess.run(["sox", "--version"],
-                            stdout=subprocess.PIPE,
-                            encoding=locale.getpreferredencoding(False))
-        get_sox_version.version = cp.stdout.split(":")[1].strip()
-    return get_sox_version.version
+    return get_tool_versions()["sox"]
 
 def get_lame_version():
-    if not hasattr(get_lame_version, "version"):
-        cp = subprocess.run(["lame", "--version"],
-                            stdout=subprocess.PIPE,
-                            encoding=locale.getpreferredencoding(False))
-        get_lame_version.version = cp.stdout.splitlines()[0].strip()
-    return get_lame_version.version
-
-def generate_description(tid, src_path, target_format):
+    return get_tool_versions()["lame"]
+
+def generate_description(tid, src_path, target_format, backend=None):
     """
     Generate a release description for apollo.rip.
 
     :param tid: ID of the source torrent.
     :param src_path: `Path` to a flac file of the source.
     :param target_format: The format of the transcode. (see `formats`)
+    :param backend: The backend used for the transcode or `None` for a
+                    `backends.CliBackend`.
 
     :returns: The description as string.
     """
+    import mutagen.flac
+
+    if backend is None:
+        backend = backends.CliBackend()
+
     flac = mutagen.flac.FLAC(src_path)
-    cmds = transcode.generate_transcode_cmds(
+    process, versions = backend.describe(
             src_path.name,
             src_path.with_suffix(target_format.SUFFIX).name,
             target_format,
             transcode.compute_resample(flac))
 
-    process = " | ".join(" ".join(cmd) for cmd in cmds)
     return ("Transcode of [url=https://apollo.rip/torrents.php?torrentid={tid}]https://apollo.rip/torrents.php?torrentid={tid}[/url].\n"
             "\n"
             "Process used:\n"
             "[code]{process}[/code]\n"
             "\n"
             "Tool versions:\n"
-            "[code]{flac}\n"
-            "{sox}\n"
-            "{lame}[/code]\n"
+            "[code]{versions}[/code]\n"
             "\n"
             "Created with apollo-cli.\n"
             "This transcode was performed by an autonomous system. Please contact me (the uploader) if it made a mistake."
            ).format(
                tid=tid,
                process=process,
-               flac=get_flac_version(),
-               sox=get_sox_version(),
-               lame=get_lame_version()
+               versions="\n".join(versions)
            )
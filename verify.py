@@ -0,0 +1,217 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Integrity check of FLAC files before transcoding.
+
+Every track is decoded with `flac -t`, which also compares the decoded audio
+with the MD5 sum in its STREAMINFO block. The results are cached on disk,
+keyed by the inode, size and modification time of the files, so every file
+is only checked once as long as it doesn't change.
+
+New results are appended to the cache file as json lines. When the file
+has grown to twice the number of cached files it is rewritten without
+the results of files which don't exist anymore.
+"""
+
+from pipeline import Pipeline, run_pipelines
+import formats
+
+from pathlib import Path
+import json
+import os
+
+def test_cmd(path):
+    return ["flac", "-t", "-s", "--", path]
+
+def file_key(path):
+    """The identity of a file in the cache: (inode, size, mtime)."""
+    st = os.stat(str(path))
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+class VerifyCache:
+    """
+    Results of earlier checks.
+
+    :param path: Path of the cache file or `None` to keep the results only
+                 in memory.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        # results which aren't saved yet
+        self.new = {}
+        # number of results in the cache file
+        self.nlines = 0
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(str(self.path), "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # e.g. cut off by a crash
+                        continue
+                    if not isinstance(entry, dict):
+                        continue
+                    if "path" in entry:
+                        self.entries[entry.pop("path")] = entry
+                        self.nlines += 1
+                    else:
+                        # a whole cache written by older versions
+                        self.entries.update(entry)
+                        self.nlines += len(entry)
+        except OSError:
+            pass
+
+    def get(self, path):
+        """
+        :returns: `None` if `path` wasn't checked in its current state or
+                  else a tuple `(ok, msg)`.
+        """
+        entry = self.entries.get(str(path))
+        if not isinstance(entry, dict):
+            return None
+        try:
+            if entry.get("key") != file_key(path):
+                return None
+        except OSError:
+            return None
+        return entry["ok"], entry.get("msg")
+
+    def set(self, path, ok, msg=None, key=None):
+        """
+        Add a result, nothing is cached if `path` can't be accessed.
+
+        :param key: The `file_key` of `path` when it was checked, if given
+                    nothing is cached if the file has changed since.
+        """
+        try:
+            current = file_key(path)
+        except OSError:
+            return
+        if key is not None and key != current:
+            return
+        entry = {"key": current, "ok": ok, "msg": msg}
+        self.entries[str(path)] = entry
+        self.new[str(path)] = entry
+
+    def save(self):
+        """Append the new results to the cache file."""
+        if self.path is None or not self.new:
+            return
+        if self.nlines + len(self.new) > 2 * len(self.entries):
+            self.compact()
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        lines = "".join(json.dumps(dict(entry, path=path)) + "\n"
+                        for path, entry in self.new.items())
+        with open(str(self.path), "ab+") as f:
+            # don't continue a line cut off by a crash or an older version
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    lines = "\n" + lines
+            f.write(lines.encode())
+        self.nlines += len(self.new)
+        self.new.clear()
+
+    def compact(self):
+        """
+        Rewrite the cache file without duplicate results and without the
+        results of files which don't exist anymore.
+
+        Results appended by other processes in the meantime are lost, they
+        are only checked again.
+        """
+        self.entries = {path: entry for path, entry in self.entries.items()
+                        if os.path.exists(path)}
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            for path, entry in self.entries.items():
+                f.write(json.dumps(dict(entry, path=path)) + "\n")
+        os.replace(tmp, str(self.path))
+        self.nlines = len(self.entries)
+        self.new.clear()
+
+def flac_files(path):
+    """All FLAC files of the release in `path`, sorted."""
+    return sorted(path.glob("**/*" + formats.FormatFlac.SUFFIX))
+
+def unchecked_files(path, cache):
+    """The FLAC files of the release in `path` which aren't in `cache`."""
+    return [f for f in flac_files(path) if cache.get(f) is None]
+
+def test_files(files, njobs=None, io_jobs=None, limiter=None):
+    """
+    Test FLAC files with `flac -t` in parallel.
+
+    The arguments after `files` are passed to `pipeline.run_pipelines`.
+
+    :returns: A `list` with a tuple `(ok, msg)` for every file.
+    """
+    results = run_pipelines([Pipeline([test_cmd(f)], inputs=[f]) for f in files],
+                            njobs, io_jobs, limiter, check=False)
+    verdicts = []
+    for r in results:
+        msg = None
+        if r.returncodes[-1] != 0:
+            lines = r.stderrs[-1].decode(errors="replace").strip().splitlines()
+            msg = lines[-1] if lines else "returncode {}".format(r.returncodes[-1])
+        verdicts.append((r.returncodes[-1] == 0, msg))
+    return verdicts
+
+def verify_release(path, cache, njobs=None, io_jobs=None, limiter=None):
+    """
+    Check all FLAC files of a release in parallel.
+
+    Files already in `cache` are not checked again, new results are added
+    to it and saved.
+
+    :param path: `Path` to the release.
+    :param cache: A `VerifyCache`.
+    :param njobs: Number of files checked in parallel or `None` for one per
+                  CPU core. `io_jobs` and `limiter` are passed to
+                  `pipeline.run_pipelines` as well.
+
+    :returns: A description of the problem if a file is corrupt or `None`
+              if all files are fine.
+    """
+    files = flac_files(path)
+    verdicts = {f: cache.get(f) for f in files}
+    unchecked = [f for f in files if verdicts[f] is None]
+    if unchecked:
+        for f, verdict in zip(unchecked, test_files(unchecked, njobs, io_jobs, limiter)):
+            verdicts[f] = verdict
+            cache.set(f, *verdict)
+        cache.save()
+
+    for f in files:
+        ok, msg = verdicts[f]
+        if not ok:
+            return "Corrupt FLAC file {}: {}".format(f.relative_to(path), msg)
+    return None
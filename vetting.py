@@ -0,0 +1,172 @@
+"""
+Copyright 2018 6x68mx <6x68mx@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Vetting of transcode candidates in a pool of worker processes.
+
+Finding the directory of a release, comparing it with the file list of the
+torrent, parsing the tags of all FLAC files and reading their STREAMINFO is
+file system I/O and python code which would otherwise block the main
+process for every candidate in turn. `Vetter` runs these checks for many
+candidates at once and hands back a small `Verdict` for each. The FLAC
+files of the releases coming up next are also tested with `flac -t`
+there, so corrupt sources are found without holding up the transcodes.
+
+The workers are started by a forkserver and not forked from apollo-cli,
+which may already run other threads (e.g. the profiler) at that point.
+"""
+
+import planner
+import util
+import verify
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+
+# Result of `vet`:
+#   path: `Path` to the release or `None` if it wasn't found.
+#   msg: The problem found by `util.check_source_release` or `None`.
+#   info: The `planner.ReleaseInfo` of the release or `None`.
+Verdict = namedtuple("Verdict", ["path", "msg", "info"])
+
+def vet(torrent, search_dirs, check=True):
+    """
+    Find the release of a torrent and check it.
+
+    :param torrent: A `dict` as returned by `api.get_torrent`.
+    :param search_dirs: `list` of directories to search. (see `util.find_dir`)
+    :param check: Run `util.check_source_release`, otherwise only find the
+                  release and read its STREAMINFO.
+
+    :returns: A `Verdict`.
+    """
+    path = util.find_dir(torrent["torrent"]["filePath"], search_dirs)
+    if path is None:
+        return Verdict(None, None, None)
+    msg = util.check_source_release(path, torrent) if check else None
+    return Verdict(path, msg, planner.probe_release(path))
+
+class Vetter:
+    """
+    Runs `vet` in a pool of worker processes.
+
+    Candidates are submitted ahead of time with `submit` and their verdict
+    is collected with `result`. Candidates which weren't submitted are vetted
+    in this process when their result is requested.
+
+    :param search_dirs: `list` of directories to search for releases.
+    :param njobs: Number of worker processes, `None` for one per CPU core
+                  or 0 to vet everything in this process.
+    """
+    def __init__(self, search_dirs, njobs=None):
+        self.search_dirs = search_dirs
+        self.njobs = njobs if njobs is not None else len(os.sched_getaffinity(0))
+        self.executor = None
+        self.futures = {}
+        # tid -> (files, file keys, future) of the background tests
+        self.verifying = {}
+
+    def _executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                    max_workers=self.njobs,
+                    mp_context=multiprocessing.get_context("forkserver"))
+        return self.executor
+
+    def submit(self, tid, torrent, check=True):
+        """Start vetting the candidate `tid` in the background."""
+        if self.njobs == 0 or (tid, check) in self.futures:
+            return
+        self.futures[(tid, check)] = self._executor().submit(vet, torrent, self.search_dirs, check)
+
+    def submitted(self, tid, check=True):
+        return (tid, check) in self.futures
+
+    def done(self, tid, check=True):
+        """
+        Get the `Verdict` of the candidate `tid` without waiting.
+
+        :returns: The `Verdict` or `None` if it wasn't submitted, isn't
+                  ready yet or failed.
+        """
+        future = self.futures.get((tid, check))
+        if future is None or not future.done() or future.cancelled():
+            return None
+        if future.exception() is not None:
+            return None
+        return future.result()
+
+    def submit_verify(self, tid, files):
+        """
+        Start testing the FLAC `files` of the candidate `tid` with
+        `verify.test_files` in the background, one file at a time.
+        """
+        if self.njobs == 0 or tid in self.verifying or not files:
+            return
+        try:
+            keys = [verify.file_key(f) for f in files]
+        except OSError:
+            return
+        future = self._executor().submit(verify.test_files, files, 1)
+        self.verifying[tid] = (files, keys, future)
+
+    def verify_submitted(self, tid):
+        return tid in self.verifying
+
+    def verify_result(self, tid):
+        """
+        Wait for the background test of the candidate `tid`.
+
+        :returns: A `list` with a tuple `(path, key, ok, msg)` for every
+                  tested file, empty if nothing was submitted. `key` is
+                  the `verify.file_key` of the file when it was submitted.
+        """
+        files, keys, future = self.verifying.pop(tid, (None, None, None))
+        if future is None:
+            return []
+        return [(f, key) + result for f, key, result in zip(files, keys, future.result())]
+
+    def result(self, tid, torrent, check=True):
+        """
+        Get the `Verdict` of the candidate `tid`.
+
+        Waits for its background job or vets it right away if it wasn't
+        submitted.
+        """
+        future = self.futures.pop((tid, check), None)
+        if future is None:
+            return vet(torrent, self.search_dirs, check)
+        return future.result()
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        for _, _, future in self.verifying.values():
+            future.cancel()
+        self.futures = {}
+        self.verifying = {}
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None